@@ -0,0 +1,78 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Compare two benchmark result files saved by benchmarks/run.py.
+
+This prints the median time of each benchmark in both files, and the ratio of
+new to old. It exits with status 1 if any benchmark got slower by more than
+the threshold, so it can gate a change.
+"""
+
+import argparse
+import json
+from pathlib import Path
+import sys
+from typing import Any
+
+
+def _load(path: Path) -> dict[tuple[str, int], dict[str, Any]]:
+    """Load results from a file, keyed by benchmark name and size."""
+    with open(path, encoding='utf-8') as file:
+        data = json.load(file)
+    return {(result['benchmark'], result['size']): result
+            for result in data['results']}
+
+
+def _parse_args() -> argparse.Namespace:
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('old', type=Path, help='results to compare against')
+    parser.add_argument('new', type=Path, help='results to compare')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='fraction slower that counts as a regression '
+             '(default: %(default)s)',
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    """Compare the result files, returning an exit status."""
+    args = _parse_args()
+    old = _load(args.old)
+    new = _load(args.new)
+    regressed = False
+
+    print(f'{"benchmark":>18} {"size":>9} {"old (s)":>12} {"new (s)":>12} '
+          f'{"new/old":>8}')
+    for key in sorted(old.keys() & new.keys()):
+        old_median = old[key]['median']
+        new_median = new[key]['median']
+        ratio = new_median / old_median if old_median else float('inf')
+        mark = ''
+        if ratio > 1 + args.threshold:
+            mark = '  slower'
+            regressed = True
+        print(f'{key[0]:>18} {key[1]:>9} {old_median:12.6f} '
+              f'{new_median:12.6f} {ratio:8.3f}{mark}')
+
+    for key in sorted(old.keys() ^ new.keys()):
+        where = 'old' if key in old else 'new'
+        print(f'{key[0]:>18} {key[1]:>9}  only in {where} results')
+
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
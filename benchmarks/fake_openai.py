@@ -0,0 +1,186 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+A fake OpenAI API endpoint on localhost, for benchmarking request fan-out.
+
+It answers embeddings and moderations requests after a fixed latency, with
+made-up but well-formed results, and counts requests and peak concurrency.
+"""
+
+__all__ = ['FakeEndpoint']
+
+import base64
+import contextlib
+import http.server
+import json
+import threading
+import time
+from typing import Any, Iterator, cast
+
+import numpy as np
+
+_DIMENSIONS = 1536
+"""Width of the embeddings returned, matching text-embedding-ada-002."""
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Handler for requests to the fake endpoint."""
+
+    server: '_Server'
+
+    # pylint: disable-next=redefined-builtin
+    def log_message(self, format: str, *args: Any) -> None:
+        """Don't log requests."""
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """Answer an embeddings or moderations request after the latency."""
+        length = int(self.headers['Content-Length'])
+        body = json.loads(self.rfile.read(length))
+
+        with self.server.active():
+            time.sleep(self.server.latency)
+            if self.path.endswith('/embeddings'):
+                response = _embeddings(body)
+            elif self.path.endswith('/moderations'):
+                response = _moderations(body)
+            else:
+                self.send_error(404)
+                return
+
+        data = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _embedding(text: str, encoding_format: str) -> Any:
+    """Make a pseudorandom unit vector for a text, in the requested format."""
+    seed = int.from_bytes(text.encode()[:8].ljust(8, b'\0'), 'little')
+    vector = np.random.default_rng([seed, len(text)]).standard_normal(
+        _DIMENSIONS, dtype=np.float32,
+    )
+    vector /= np.linalg.norm(vector)
+    if encoding_format == 'base64':
+        return base64.b64encode(vector.astype('<f4').tobytes()).decode()
+    return vector.tolist()
+
+
+def _embeddings(body: dict[str, Any]) -> dict[str, Any]:
+    """Respond to an embeddings request."""
+    encoding_format = body.get('encoding_format', 'float')
+    return {
+        'object': 'list',
+        'data': [
+            {
+                'object': 'embedding',
+                'index': index,
+                'embedding': _embedding(text, encoding_format),
+            }
+            for index, text in enumerate(body['input'])
+        ],
+        'model': body.get('model', 'text-embedding-ada-002'),
+        'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+    }
+
+
+def _moderations(body: dict[str, Any]) -> dict[str, Any]:
+    """Respond to a moderations request, flagging nothing."""
+    return {
+        'id': 'modr-fake',
+        'model': 'text-moderation-fake',
+        'results': [
+            {
+                'flagged': False,
+                'categories': {'hate': False, 'violence': False},
+                'category_scores': {'hate': len(text) / 1e6,
+                                    'violence': len(text) / 1e7},
+            }
+            for text in body['input']
+        ],
+    }
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    """HTTP server that keeps statistics on the requests it is handling."""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float) -> None:
+        """Create a server on a free port on localhost."""
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.latency = latency
+        self.requests = 0
+        self.peak = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def active(self) -> Iterator[None]:
+        """Count a request as being handled, for the duration of a block."""
+        with self._lock:
+            self.requests += 1
+            self._active += 1
+            self.peak = max(self.peak, self._active)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+
+
+class FakeEndpoint:
+    """A running fake endpoint, which openai is configured to use."""
+
+    __slots__ = ('_server', '_thread')
+
+    def __init__(self, latency: float) -> None:
+        """Start serving in a background thread and point openai at it."""
+        # pylint: disable-next=import-outside-toplevel
+        import openai
+
+        self._server = _Server(latency)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+        host, port = cast(tuple[str, int], self._server.server_address[:2])
+        openai.api_base = f'http://{host}:{port}/v1'
+        openai.api_key = 'sk-fake'
+
+    def __enter__(self) -> 'FakeEndpoint':
+        """Use this endpoint for the duration of a block."""
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def reset(self) -> None:
+        """Reset the request count and peak concurrency."""
+        self._server.requests = 0
+        self._server.peak = 0
+
+    @property
+    def requests(self) -> int:
+        """How many requests were received since the last reset."""
+        return self._server.requests
+
+    @property
+    def peak(self) -> int:
+        """Most requests handled at once since the last reset."""
+        return self._server.peak
@@ -0,0 +1,376 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Offline benchmarks of caching, searching, token counting, and API fan-out.
+
+Repository names are synthetic and embeddings are random, both made from a
+fixed seed, so runs are reproducible. API requests go to a fake endpoint on
+localhost that answers after a set latency. Everything is written to a
+temporary data directory, never to the real cache.
+
+Results are saved as JSON, by default in benchmarks/results, named by time and
+commit. Compare two result files with benchmarks/compare.py.
+
+Token counting, rendering, and embedding fan-out need the cl100k_base encoding,
+which tiktoken downloads on first use. When it isn't available, those
+benchmarks are skipped, and the result file lists them as skipped.
+"""
+
+import argparse
+import datetime
+import functools
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+_DIMENSIONS = 1536
+"""Width of the random embeddings, matching text-embedding-ada-002."""
+
+_QUERY_COUNT = 100
+"""How many random queries each top-k search benchmark runs."""
+
+_K = 10
+"""How many results each top-k search asks for."""
+
+_WORDS = (
+    'api', 'app', 'async', 'bench', 'cache', 'cli', 'config', 'core', 'data',
+    'demo', 'docs', 'embed', 'engine', 'experiment', 'find', 'git', 'graph',
+    'http', 'index', 'kit', 'lab', 'lib', 'lint', 'model', 'net', 'notes',
+    'parser', 'plugin', 'py', 'query', 'repo', 'rs', 'search', 'server',
+    'shell', 'sync', 'test', 'tool', 'utils', 'vector', 'web', 'wiki',
+)
+"""Words that synthetic repository names are made from."""
+
+_SEPARATORS = ('-', '_', '', '.')
+"""Separators between words in synthetic repository names."""
+
+_REPO_ROOT = Path(__file__).absolute().parent.parent
+"""The root of the repository these benchmarks are in."""
+
+
+def _make_names(count: int, seed: int) -> list[str]:
+    """Make distinct synthetic repository names, reproducibly."""
+    rng = random.Random(seed)
+    names: list[str] = []
+    seen: set[str] = set()
+
+    while len(names) < count:
+        words = rng.sample(_WORDS, rng.randint(1, 3))
+        if rng.random() < 0.3:
+            words[rng.randrange(len(words))] = words[0].capitalize()
+        name = rng.choice(_SEPARATORS).join(words)
+        if rng.random() < 0.5:
+            name += str(rng.randrange(1000))
+        if name in seen:
+            name += f'-{len(names)}'
+        seen.add(name)
+        names.append(name)
+
+    return names
+
+
+def _make_matrix(count: int, seed: int) -> np.ndarray:
+    """Make a reproducible matrix of random float32 unit vectors."""
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((count, _DIMENSIONS), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix
+
+
+class _Runner:
+    """Runs benchmarks, collecting their results and which were skipped."""
+
+    __slots__ = ('_repeat', '_data_dir', 'results', 'skipped')
+
+    def __init__(self, repeat: int, data_dir: Path) -> None:
+        """Create a runner that times each benchmark repeat times."""
+        self._repeat = repeat
+        self._data_dir = data_dir
+        self.results: list[dict[str, Any]] = []
+        self.skipped: dict[str, str] = {}
+
+    def clear_data(self) -> None:
+        """Delete everything in the temporary data directory."""
+        for path in self._data_dir.iterdir():
+            path.unlink()
+
+    def time(self, name: str, size: int, func: Callable[[], Any], *,
+             setup: Optional[Callable[[], None]] = None,
+             per: int = 1, **params: Any) -> None:
+        """Time func, after setup if given, and record the result."""
+        times = []
+        for _ in range(self._repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            times.append((time.perf_counter() - start) / per)
+
+        result = {
+            'benchmark': name,
+            'size': size,
+            'params': params,
+            'times': times,
+            'min': min(times),
+            'median': statistics.median(times),
+        }
+        self.results.append(result)
+        print(f'{name:>18} {size:>9} {result["median"]:12.6f} s '
+              f'(min {result["min"]:.6f} s)', flush=True)
+
+    def skip(self, name: str, reason: str) -> None:
+        """Record that a benchmark was skipped, and why."""
+        self.skipped[name] = reason
+        print(f'{name:>18} skipped: {reason}', flush=True)
+
+
+def _bench_cache(runner: _Runner, names: list[str],
+                 matrix: np.ndarray) -> None:
+    """Benchmark writing, then reading, an api_task cache of embeddings."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import _task
+
+    rows = {name: index for index, name in enumerate(names)}
+
+    def fake_api(texts: list[str]) -> np.ndarray:
+        return matrix[[rows[text] for text in texts]]
+
+    task = _task.api_task('bench', store=functools.partial(
+        _task.ArrayStore, model='bench', dim=_DIMENSIONS,
+    ))(fake_api)
+
+    runner.time('cache-write', len(names), lambda: task(names),
+                setup=runner.clear_data)
+    runner.time('cache-read', len(names), lambda: task(names))
+    runner.clear_data()
+
+
+def _bench_search(runner: _Runner, names: list[str],
+                  matrix: np.ndarray, seed: int) -> None:
+    """Benchmark building indexes and searching them for random queries."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import compact, lexical, search
+
+    queries = _make_matrix(_QUERY_COUNT, seed + 1)
+    index = search.Index(names, matrix)
+
+    def run_queries() -> None:
+        for query in queries:
+            index.search(query, _K)
+
+    runner.time('search-build', len(names),
+                lambda: search.Index(names, matrix))
+    runner.time('search-query', len(names), run_queries,
+                per=_QUERY_COUNT, k=_K)
+
+    def run_compact_queries(compact_index: compact.CompactIndex) -> None:
+        for query in queries:
+            compact_index.search(query, _K)
+
+    for precision in typing.get_args(compact.Precision):
+        runner.time(f'compact-{precision}', len(names), functools.partial(
+            run_compact_queries,
+            compact.CompactIndex(index, precision=precision),
+        ), per=_QUERY_COUNT, k=_K, dims=compact.DEFAULT_DIMS)
+
+    texts = _make_names(_QUERY_COUNT, seed + 1)
+    lexical_index = lexical.LexicalIndex(names)
+
+    def run_lexical_queries() -> None:
+        for text in texts:
+            lexical_index.search(text, _K)
+
+    runner.time('lexical-build', len(names),
+                lambda: lexical.LexicalIndex(names))
+    runner.time('lexical-query', len(names), run_lexical_queries,
+                per=_QUERY_COUNT, k=_K)
+
+
+def _bench_tokens(runner: _Runner, names: list[str]) -> None:
+    """Benchmark counting tokens, cold and cached, and rendering them."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import tokens
+
+    runner.time('count-cold', len(names), lambda: tokens.count(names),
+                setup=runner.clear_data)
+    runner.time('count-warm', len(names), lambda: tokens.count(names))
+    runner.clear_data()
+
+    def render(target: tokens.Target) -> None:
+        tokens.show(names, target=target, file=io.StringIO())
+
+    runner.time('render-ansi', len(names), lambda: render('ansi'))
+    runner.time('render-html', len(names), lambda: render('html'))
+
+
+def _bench_fanout(runner: _Runner, names: list[str],
+                  latency: float) -> None:
+    """Benchmark embed_many and get_moderation against the fake endpoint."""
+    # pylint: disable-next=import-outside-toplevel
+    from fake_openai import FakeEndpoint
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import embedding, moderation
+
+    def setup() -> None:
+        runner.clear_data()
+        endpoint.reset()
+
+    with FakeEndpoint(latency) as endpoint:
+        for name, func in (('embed-fanout', embedding.embed_many),
+                           ('moderation-fanout', moderation.get_moderation)):
+            runner.time(name, len(names), functools.partial(func, names),
+                        setup=setup, latency=latency)
+            runner.results[-1]['params'].update(requests=endpoint.requests,
+                                                peak=endpoint.peak)
+
+    runner.clear_data()
+
+
+def _encoding_problem() -> Optional[str]:
+    """Check if the cl100k_base encoding can be loaded. If not, say why."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import tokens
+    try:
+        tokens._get_encoding()  # pylint: disable=protected-access
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        return f"can't load cl100k_base encoding: {error}"
+    return None
+
+
+def _git_commit() -> Optional[str]:
+    """Get the commit checked out, marked if there are changes, if known."""
+    try:
+        commit = subprocess.run(
+            ['git', 'describe', '--always', '--dirty', '--abbrev=40'],
+            cwd=_REPO_ROOT, capture_output=True, check=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit
+
+
+def _metadata(args: argparse.Namespace) -> dict[str, Any]:
+    """Describe the environment and settings of this run."""
+    return {
+        'commit': _git_commit(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'sizes': args.sizes,
+        'fanout_size': args.fanout_size,
+        'latency': args.latency,
+        'repeat': args.repeat,
+        'seed': args.seed,
+    }
+
+
+def _parse_args() -> argparse.Namespace:
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+        help='numbers of names to benchmark with (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--fanout-size', type=int, default=10_000,
+        help='number of names to send to the fake endpoint '
+             '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.05,
+        help='seconds the fake endpoint waits before answering '
+             '(default: %(default)s)',
+    )
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to run each benchmark (default: 3)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for synthetic data (default: 0)')
+    parser.add_argument('--only', nargs='+',
+                        choices=['cache', 'search', 'tokens', 'fanout'],
+                        help='run only these groups of benchmarks')
+    parser.add_argument('--output', type=Path,
+                        help='file to save results to (default: in '
+                             'benchmarks/results, named by time and commit)')
+    return parser.parse_args()
+
+
+def _default_output(metadata: dict[str, Any]) -> Path:
+    """Choose a results file path from when and on what commit we ran."""
+    stamp = datetime.datetime.fromisoformat(metadata['time'])
+    commit = (metadata['commit'] or 'unknown')[:12]
+    name = f'{stamp:%Y%m%dT%H%M%SZ}-{commit}.json'
+    return _REPO_ROOT / 'benchmarks' / 'results' / name
+
+
+def main() -> None:
+    """Run the benchmarks and save the results."""
+    args = _parse_args()
+    groups = set(args.only or ['cache', 'search', 'tokens', 'fanout'])
+    metadata = _metadata(args)
+
+    data_dir = Path(tempfile.mkdtemp(prefix='fr2ex-bench-'))
+    os.environ['FR2EX_DATA_DIR'] = str(data_dir)
+    os.environ['OPENAI_API_KEY'] = 'sk-fake'
+    runner = _Runner(args.repeat, data_dir)
+
+    try:
+        problem = _encoding_problem()
+        if problem is not None:
+            for group in sorted(groups & {'tokens', 'fanout'}):
+                runner.skip(group, problem)
+                groups.remove(group)
+
+        for size in args.sizes:
+            names = _make_names(size, args.seed)
+            matrix = _make_matrix(size, args.seed)
+            if 'cache' in groups:
+                _bench_cache(runner, names, matrix)
+            if 'search' in groups:
+                _bench_search(runner, names, matrix, args.seed)
+            if 'tokens' in groups:
+                _bench_tokens(runner, names)
+            del matrix
+
+        if 'fanout' in groups:
+            names = _make_names(args.fanout_size, args.seed + 2)
+            _bench_fanout(runner, names, args.latency)
+    finally:
+        shutil.rmtree(data_dir)
+
+    output = args.output or _default_output(metadata)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, mode='w', encoding='utf-8') as file:
+        json.dump({'metadata': metadata, 'results': runner.results,
+                   'skipped': runner.skipped}, file, indent=4)
+        file.write('\n')
+    print(f'Saved results to {output}.')
+
+
+if __name__ == '__main__':
+    main()
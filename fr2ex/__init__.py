@@ -11,8 +11,62 @@
 # OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
-"""Modules for findrepo2 experiments."""
+"""
+Modules for findrepo2 experiments.
 
-__all__ = ['embedding', 'moderation', 'paths', 'remote', 'tokens']
+Submodules are imported on first access, so that importing this package, or a
+light submodule, doesn't pay for the heavy dependencies of the others.
+"""
 
-from fr2ex import embedding, moderation, paths, remote, tokens
+__all__ = [
+    'ann',
+    'cli',
+    'compact',
+    'daemon',
+    'embedding',
+    'lexical',
+    'metrics',
+    'moderation',
+    'pairs',
+    'paths',
+    'pipeline',
+    'remote',
+    'search',
+    'sharded',
+    'tokens',
+]
+
+import importlib
+from types import ModuleType
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from fr2ex import (
+        ann,
+        cli,
+        compact,
+        daemon,
+        embedding,
+        lexical,
+        metrics,
+        moderation,
+        pairs,
+        paths,
+        pipeline,
+        remote,
+        search,
+        sharded,
+        tokens,
+    )
+
+
+def __getattr__(name: str) -> ModuleType:
+    """Import a submodule on first access."""
+    if name not in __all__:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return importlib.import_module(f'{__name__}.{name}')
+
+
+def __dir__() -> list[str]:
+    """List the module's attributes, including submodules not yet imported."""
+    return sorted({*globals(), *__all__})
@@ -14,37 +14,114 @@
 """Shared custom logic for accessing the OpenAI API and caching results."""
 
 __all__ = [
+    'build_key',
     'ensure_api_key',
+    'with_retries',
+    'map_concurrently',
+    'plan_batches',
+    'replace_atomically',
+    'Store',
+    'RecordStore',
+    'ArrayStore',
     'Task',
     'TaskDecorator',
     'api_task',
+    'register',
+    'touch',
+    'cache_size',
+    'prune',
 ]
 
+import collections
+import concurrent.futures
 import contextlib
+import datetime
+import fcntl
 import functools
 import json
 import logging
+import operator
 import os
 from pathlib import Path
-from typing import Protocol, TypeVar
+import random
+import secrets
+import stat
+import tempfile
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Collection,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    Protocol,
+    Sequence,
+    TypeVar,
+)
 
 from blake3 import blake3  # type: ignore[import]
 import msgpack
 import msgpack_numpy
-import openai
+import numpy as np
 
-from fr2ex import paths
+from fr2ex import metrics, paths
+
+if TYPE_CHECKING:
+    import openai.error
 
 _T = TypeVar('_T')
 """Invariant type parameter, used for API task return types."""
 
+_A = TypeVar('_A')
+"""Invariant type parameter, used for arguments to functions called in bulk."""
+
 _T_co = TypeVar('_T_co', covariant=True)
 """Covariant type parameter, used for API return-type protocol parameters."""
 
+_ARRAY_FORMAT = 1
+"""Version of the ArrayStore index format. Increment on incompatible change."""
+
+_BLOCK_ROWS = 4096
+"""Number of rows to copy at a time when rewriting an ArrayStore."""
+
+_ACCESS_RESOLUTION = datetime.timedelta(hours=1)
+"""How old a recorded access time must be for touch to rewrite it."""
+
+_MAX_ATTEMPTS = 6
+"""Maximum number of times with_retries will attempt a request."""
+
+_INITIAL_BACKOFF = datetime.timedelta(seconds=1)
+"""Upper bound of the first delay before retrying, which doubles each time."""
+
+_MAX_BACKOFF = datetime.timedelta(seconds=60)
+"""Upper bound of all delays before retrying."""
+
+
+def _read_umask() -> int:
+    """Get the umask. Reading it means briefly setting it, then restoring."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+_NEW_FILE_MODE = 0o666 & ~_read_umask()
+"""The permissions open() gives new files, given the umask at import time.
+
+The umask is read once, before threads that create files are likely to run.
+"""
+
 msgpack_numpy.patch()
 
 
-def _build_path(task_name: str, texts: list[str]) -> Path:
+def build_key(text: str) -> str:
+    """Build a cache key for a single text from a blake3 hash of the text."""
+    return blake3(text.encode()).hexdigest(length=16)
+
+
+def _build_legacy_path(task_name: str, texts: list[str]) -> Path:
     """Build a pathname with the task name and a blake3 hash of the texts."""
     json_bytes = json.dumps(texts).encode()
     hexdigest = blake3(json_bytes).hexdigest(length=16)
@@ -53,6 +130,8 @@ def _build_path(task_name: str, texts: list[str]) -> Path:
 
 def ensure_api_key() -> None:
     """Load the OpenAI API key from a key file, if it is not yet loaded."""
+    # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+    import openai
     if openai.api_key is None and openai.api_key_path is None:
         try:
             openai.api_key = os.environ['OPENAI_API_KEY']
@@ -60,6 +139,511 @@ def ensure_api_key() -> None:
             openai.api_key_path = str(paths.default_api_key_file)
 
 
+@functools.cache
+def _transient_errors() -> tuple[type['openai.error.OpenAIError'], ...]:
+    """Get OpenAI API errors after which retrying a request may succeed."""
+    # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+    import openai.error
+    return (
+        openai.error.APIConnectionError,
+        openai.error.APIError,
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.Timeout,
+    )
+
+
+def _retry_after(error: 'openai.error.OpenAIError') -> Optional[float]:
+    """Get the number of seconds the server asked us to wait, if any."""
+    try:
+        return max(float(error.headers['retry-after']), 0.0)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def with_retries(func: Callable[[], _T]) -> _T:
+    """
+    Call func, retrying with exponential backoff on transient API errors.
+
+    Delays are random, up to a bound that doubles after each failure (so
+    concurrent callers don't retry in lockstep), unless the server sends a
+    Retry-After header. After _MAX_ATTEMPTS failures, the last error is raised.
+    """
+    bound = _INITIAL_BACKOFF.total_seconds()
+
+    for attempt in range(1, _MAX_ATTEMPTS):
+        try:
+            return func()
+        except _transient_errors() as error:
+            delay = _retry_after(error)
+            if delay is None:
+                delay = random.uniform(0, bound)
+            logging.warning('Attempt %d failed (%s). Retrying in %.1f s.',
+                            attempt, error, delay)
+            time.sleep(delay)
+            bound = min(bound * 2, _MAX_BACKOFF.total_seconds())
+
+    return func()
+
+
+def map_concurrently(func: Callable[[_A], _T], items: Sequence[_A], *,
+                     max_workers: int) -> list[_T]:
+    """
+    Call func on each item, with retries, in up to max_workers threads.
+
+    This is for sending API requests concurrently. Each request is retried on
+    its own, by with_retries. The results are returned in the order of items.
+    """
+    if len(items) <= 1:
+        return [with_retries(functools.partial(func, item)) for item in items]
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(items)),
+    ) as executor:
+        return list(executor.map(
+            lambda item: with_retries(functools.partial(func, item)),
+            items,
+        ))
+
+
+def plan_batches(weights: Sequence[int], *,
+                 max_count: int, max_weight: int) -> list[range]:
+    """
+    Split indices into consecutive batches, limiting their counts and weights.
+
+    Each batch has at most max_count items whose weights (such as token counts)
+    sum to at most max_weight, except that an item that is heavier than
+    max_weight by itself is put alone in its own batch.
+    """
+    batches = []
+    start = 0
+    total = 0
+
+    for index, weight in enumerate(weights):
+        if index > start and (index - start == max_count
+                              or total + weight > max_weight):
+            batches.append(range(start, index))
+            start = index
+            total = 0
+        total += weight
+
+    if start < len(weights):
+        batches.append(range(start, len(weights)))
+
+    return batches
+
+
+def replace_atomically(path: Path, write: Callable[[Any], None]) -> None:
+    """
+    Write a file through a temporary file, then rename it into place.
+
+    The file gets the permissions of the file it replaces, if there is one,
+    or else those open() would give it. (Temporary files are owner-only.)
+    """
+    try:
+        mode = stat.S_IMODE(path.stat().st_mode)
+    except FileNotFoundError:
+        mode = _NEW_FILE_MODE
+
+    with tempfile.NamedTemporaryFile(
+        mode='wb', dir=path.parent, prefix=f'{path.name}.', suffix='.tmp',
+        delete=False,
+    ) as file:
+        try:
+            write(file)
+            os.chmod(file.name, mode)
+        except BaseException:
+            file.close()
+            os.remove(file.name)
+            raise
+    os.replace(file.name, path)
+
+
+def _is_run(positions: np.ndarray) -> bool:
+    """Check if positions are nonempty, ascending, and consecutive."""
+    return len(positions) != 0 and bool((np.diff(positions) == 1).all())
+
+
+@contextlib.contextmanager
+def _locked(path: Path) -> Iterator[None]:
+    """
+    Hold an exclusive lock associated with path, for the duration of a block.
+
+    The lock is an advisory lock on a separate, empty file beside path. Code
+    that changes a store's files holds its lock, so concurrent writers, even in
+    different processes, never interleave or truncate each other's writes.
+    """
+    with open(path.with_name(f'{path.name}.lock'), 'ab') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        yield  # Closing the file releases the lock.
+
+
+class Store(Protocol):
+    """Protocol for per-text caches of API task results, keyed by text hash."""
+
+    bytes_read: int
+    """Bytes read from the store's files, including results handed out."""
+
+    bytes_written: int
+    """Bytes written to the store's files."""
+
+    def __contains__(self, key: str) -> bool:
+        """Check if a result is saved for the text with the given key."""
+
+    def add(self, keys: list[str], texts: list[str], results: Any) -> None:
+        """Save results for distinct texts with the given keys, in order."""
+
+    def gather(self, keys: list[str], *, compact: bool) -> Any:
+        """Get saved results for the given keys, ordered like the keys."""
+
+    def sizes(self) -> dict[str, int]:
+        """Get the approximate number of bytes each saved result takes up."""
+
+    def evict(self, keys: Collection[str]) -> None:
+        """Remove the saved results for the given keys, rewriting the store."""
+
+
+class RecordStore:
+    """
+    Per-text results of an API task, kept in an append-only msgpack file.
+
+    The file is a stream of ``[key, result]`` pairs, where each key is built
+    from the text by ``build_key``. New results are appended, so adding texts
+    never rewrites results that were already saved. If a write was interrupted,
+    the incomplete pair at the end is ignored, and overwritten by the next one.
+    Before appending, a store reads what other writers have appended since it
+    was loaded. Evicting results writes a new file and renames it into place.
+    """
+
+    __slots__ = ('_path', '_inode', '_size', '_results',
+                 'bytes_read', 'bytes_written')
+
+    def __init__(self, task_name: str) -> None:
+        """Load the saved results of the task with the given name."""
+        self._path = paths.data_dir / f'{task_name}.msgpack'
+        self._inode: Optional[int] = None
+        self._size = 0
+        self._results: dict[str, Any] = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._load()
+
+    def __contains__(self, key: str) -> bool:
+        """Check if a result is saved for the text with the given key."""
+        return key in self._results
+
+    def add(self, keys: list[str], texts: list[str], results: Any) -> None:
+        """Save results for distinct texts with the given keys, in order."""
+        del texts  # Only the keys are needed to look results up.
+
+        with _locked(self._path):
+            self._load()
+            with open(self._path, 'ab') as file:
+                file.truncate(self._size)
+                for key, result in zip(keys, results):
+                    if key not in self._results:
+                        msgpack.pack([key, result], file)
+                        self._results[key] = result
+                self.bytes_written += file.tell() - self._size
+                self._size = file.tell()
+                self._inode = os.fstat(file.fileno()).st_ino
+
+    def gather(self, keys: list[str], *, compact: bool) -> list[Any]:
+        """Get saved results for the given keys, as a list ordered likewise."""
+        del compact  # There is no advantage to storing records in any order.
+        return [self._results[key] for key in keys]
+
+    def sizes(self) -> dict[str, int]:
+        """Get the number of bytes each saved result's pair takes up."""
+        return {key: len(msgpack.packb([key, result]))
+                for key, result in self._results.items()}
+
+    def evict(self, keys: Collection[str]) -> None:
+        """Remove the saved results for the given keys, rewriting the file."""
+        with _locked(self._path):
+            self._load()
+            for key in keys:
+                self._results.pop(key, None)
+
+            def write(file: Any) -> None:
+                for pair in self._results.items():
+                    msgpack.pack(pair, file)
+
+            replace_atomically(self._path, write)
+            status = self._path.stat()
+            self._inode = status.st_ino
+            self._size = status.st_size
+            self.bytes_written += status.st_size
+
+    def _load(self) -> None:
+        """Read pairs appended since the last load, or all if replaced."""
+        try:
+            with open(self._path, 'rb') as file:
+                inode = os.fstat(file.fileno()).st_ino
+                if inode != self._inode:
+                    self._inode = inode
+                    self._size = 0
+                    self._results.clear()
+
+                start = self._size
+                file.seek(start)
+                unpacker = msgpack.Unpacker(file, raw=False)
+                for key, result in unpacker:
+                    self._results[key] = result
+                    self._size = start + unpacker.tell()
+                self.bytes_read += self._size - start
+        except FileNotFoundError:
+            self._inode = None
+            self._size = 0
+            self._results.clear()
+
+
+class ArrayStore:  # pylint: disable=too-many-instance-attributes
+    """
+    Per-text rows of an API task's result matrix, in a memory-mapped file.
+
+    Rows are kept as raw float32 data in a ``.f32`` file that is mapped
+    read-only, so loading takes constant time, and processes reading the same
+    rows share them in the page cache. An index file holds a header, with the
+    model and the row width, followed by a ``[key, text]`` pair for each row.
+    Both files are append-only, except when a store is compacted or results
+    are evicted, which writes new files and renames them into place. Rows are
+    always written before the pairs that refer to them, so a reader never sees
+    a pair without its row. Like ``RecordStore``, a store catches up on other
+    writers' changes before making its own.
+    """
+
+    __slots__ = ('_index_path', '_model', '_dim', '_header', '_rows',
+                 '_texts', '_index_inode', '_index_size', '_data_path',
+                 '_matrix', 'bytes_read', 'bytes_written')
+
+    def __init__(self, task_name: str, *, model: str, dim: int) -> None:
+        """Load the index and map the rows of the task with the given name."""
+        self._index_path = self.index_path(task_name)
+        self._model = model
+        self._dim = dim
+        self._header: dict[str, Any] = {}
+        self._rows: dict[str, int] = {}
+        self._texts: list[str] = []
+        self._index_inode: Optional[int] = None
+        self._index_size = 0
+        self._data_path = paths.data_dir  # Set from the header by _load.
+        self._matrix = np.empty((0, dim), np.float32)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._load()
+
+    @staticmethod
+    def index_path(task_name: str) -> Path:
+        """
+        The path of the index file for the task with the given name.
+
+        This file is modified or replaced whenever the store changes.
+        """
+        return paths.data_dir / f'{task_name}.index'
+
+    def __contains__(self, key: str) -> bool:
+        """Check if a row is saved for the text with the given key."""
+        return key in self._rows
+
+    def add(self, keys: list[str], texts: list[str], results: Any) -> None:
+        """Save rows for distinct texts with the given keys, in order."""
+        matrix = np.asarray(results, np.float32).reshape(len(keys), self._dim)
+
+        with _locked(self._index_path):
+            self._load()
+            new = [index for index, key in enumerate(keys)
+                   if key not in self._rows]
+            if len(new) < len(keys):  # Another writer saved some of them.
+                matrix = matrix[new]
+                keys = [keys[index] for index in new]
+                texts = [texts[index] for index in new]
+
+            with open(self._data_path, 'ab') as file:
+                file.truncate(len(self._texts) * self._row_size)
+                file.write(matrix.tobytes())
+            self.bytes_written += matrix.nbytes
+
+            with open(self._index_path, 'ab') as file:
+                file.truncate(self._index_size)
+                if self._index_size == 0:
+                    msgpack.pack(self._header, file)
+                for key, text in zip(keys, texts):
+                    msgpack.pack([key, text], file)
+                    self._rows[key] = len(self._texts)
+                    self._texts.append(text)
+                self.bytes_written += file.tell() - self._index_size
+                self._index_size = file.tell()
+                self._index_inode = os.fstat(file.fileno()).st_ino
+
+        self._matrix = self._map()
+
+    def gather(self, keys: list[str], *, compact: bool) -> np.ndarray:
+        """
+        Get saved rows for the given keys, as a matrix ordered likewise.
+
+        If the rows are stored contiguously, in order, the matrix is a
+        read-only view of the mapped file. Otherwise it is a copy, and if
+        ``compact`` is true, the store is rewritten with the rows in this
+        order, so the same request is a view next time.
+        """
+        positions = np.fromiter((self._rows[key] for key in keys),
+                                dtype=np.intp, count=len(keys))
+        self.bytes_read += len(keys) * self._row_size
+
+        if _is_run(positions):
+            start = positions[0]
+            return np.asarray(self._matrix[start:start + len(positions)])
+
+        if compact:
+            _, first_indices = np.unique(positions, return_index=True)
+            distinct_positions = positions[np.sort(first_indices)]
+            if not _is_run(distinct_positions):
+                self._compact(list(dict.fromkeys(keys)))
+                self.bytes_read -= len(keys) * self._row_size
+                return self.gather(keys, compact=False)
+
+        return self._matrix[positions]
+
+    def sizes(self) -> dict[str, int]:
+        """Get the number of bytes each saved row and its pair take up."""
+        return {
+            key: self._row_size + len(msgpack.packb([key, self._texts[row]]))
+            for key, row in self._rows.items()
+        }
+
+    def evict(self, keys: Collection[str]) -> None:
+        """Remove the saved rows for the given keys, rewriting the store."""
+        with _locked(self._index_path):
+            self._load()
+            kept = np.ones(len(self._texts), dtype=bool)
+            kept[[self._rows[key] for key in keys
+                  if key in self._rows]] = False
+            self._rewrite(np.flatnonzero(kept))
+
+    @property
+    def _row_size(self) -> int:
+        """The number of bytes in each row."""
+        return self._dim * np.dtype(np.float32).itemsize
+
+    def _check_header(self, header: dict[str, Any]) -> dict[str, Any]:
+        """Make sure the header describes rows that this store can use."""
+        if header.get('format') != _ARRAY_FORMAT:
+            raise ValueError(f'{self._index_path} has unsupported format')
+        if header['model'] != self._model or header['dim'] != self._dim:
+            raise ValueError(f"{self._index_path} has {header['dim']}-"
+                             f"dimensional rows from {header['model']!r}")
+        return header
+
+    def _load(self) -> None:
+        """Read pairs appended since the last load, and map the rows."""
+        self._read_index()
+        try:
+            self._matrix = self._map()
+        except FileNotFoundError:
+            # The store was rewritten between reading the index and mapping
+            # the rows it referred to. Read the new index from the beginning.
+            self._index_inode = None
+            self._read_index()
+            self._matrix = self._map()
+
+    def _read_index(self) -> None:
+        """Read pairs appended since the last read, or all if replaced."""
+        try:
+            with open(self._index_path, 'rb') as file:
+                inode = os.fstat(file.fileno()).st_ino
+                if inode != self._index_inode:
+                    self._reset(inode)
+
+                start = self._index_size
+                file.seek(start)
+                unpacker = msgpack.Unpacker(file, raw=False)
+                if start == 0:
+                    with contextlib.suppress(StopIteration):
+                        self._header = self._check_header(next(unpacker))
+                        self._index_size = unpacker.tell()
+                for key, text in unpacker:
+                    self._rows[key] = len(self._texts)
+                    self._texts.append(text)
+                    self._index_size = start + unpacker.tell()
+                self.bytes_read += self._index_size - start
+        except FileNotFoundError:
+            self._reset(None)
+
+        if not self._header:
+            self._header = {
+                'format': _ARRAY_FORMAT,
+                'model': self._model,
+                'dim': self._dim,
+                'data': f'{self._index_path.stem}-{secrets.token_hex(8)}.f32',
+            }
+
+        self._data_path = paths.data_dir / self._header['data']
+
+    def _reset(self, inode: Optional[int]) -> None:
+        """Forget everything read from the index, which has been replaced."""
+        self._header = {}
+        self._rows.clear()
+        self._texts.clear()
+        self._index_inode = inode
+        self._index_size = 0
+
+    def _map(self) -> np.ndarray:
+        """Map the rows that the index refers to, read-only."""
+        count = len(self._texts)
+        if count == 0:
+            return np.empty((0, self._dim), np.float32)
+        return np.memmap(self._data_path, dtype=np.float32, mode='r',
+                         shape=(count, self._dim))
+
+    def _compact(self, keys: list[str]) -> None:
+        """Rewrite the store with rows for these distinct keys first."""
+        with _locked(self._index_path):
+            self._load()
+            positions = np.fromiter((self._rows[key] for key in keys),
+                                    dtype=np.intp, count=len(keys))
+            if not _is_run(positions):
+                logging.info('Compacting %s.', self._index_path.name)
+                self._rewrite(np.concatenate((
+                    positions,
+                    np.setdiff1d(np.arange(len(self._texts)), positions),
+                )))
+
+    def _rewrite(self, order: np.ndarray) -> None:
+        """Rewrite the store with just the rows at these positions."""
+        texts = [self._texts[position] for position in order]
+        old_data_path = self._data_path
+
+        token = secrets.token_hex(8)
+        header = {**self._header,
+                  'data': f'{self._index_path.stem}-{token}.f32'}
+        data_path = paths.data_dir / header['data']
+
+        def write_data(file: Any) -> None:
+            for start in range(0, len(order), _BLOCK_ROWS):
+                block = order[start:start + _BLOCK_ROWS]
+                file.write(self._matrix[block].tobytes())
+
+        def write_index(file: Any) -> None:
+            msgpack.pack(header, file)
+            for text in texts:
+                msgpack.pack([build_key(text), text], file)
+
+        replace_atomically(data_path, write_data)
+        replace_atomically(self._index_path, write_index)
+
+        status = self._index_path.stat()
+        self._header = header
+        self._data_path = data_path
+        self._texts = texts
+        self._rows = {build_key(text): row for row, text in enumerate(texts)}
+        self._index_inode = status.st_ino
+        self._index_size = status.st_size
+        self._matrix = self._map()
+        old_data_path.unlink(missing_ok=True)
+        self.bytes_written += len(order) * self._row_size + self._index_size
+
+
 class Task(Protocol[_T_co]):
     """Protocol for callables providing core logic of API tasks."""
 
@@ -72,28 +656,284 @@ class TaskDecorator(Protocol):
     def __call__(self, func: Task[_T]) -> Task[_T]: ...
 
 
-def api_task(task_name: str) -> TaskDecorator:
-    """Decorator factory to load a saved result or query the OpenAI API."""
+def _query_missing(func: Task[Any], cache: Store, missing: dict[str, str],
+                   checkpoint: Optional[int]) -> float:
+    """
+    Query for texts with no saved result, saving after each call to func.
+
+    Missing texts map from their keys. This returns the seconds spent in func.
+    """
+    keys = list(missing)
+    texts = list(missing.values())
+    step = checkpoint or len(texts)
+    api_seconds = 0.0
+
+    for offset in range(0, len(texts), step):
+        batch = slice(offset, offset + step)
+        queried = time.perf_counter()
+        results = func(texts[batch])
+        api_seconds += time.perf_counter() - queried
+        cache.add(keys[batch], texts[batch], results)
+
+    return api_seconds
+
+
+def _import_legacy(store: Store, task_name: str,
+                   keys: list[str], texts: list[str]) -> None:
+    """
+    Merge a whole-list file for these texts into the store, if there is one.
+
+    If there is no such file, its ``-old`` copy is used, if there is one.
+    Whole-list files are left in place, since notebooks still read them. They
+    are only read here when the store lacks some of the results for the texts.
+    """
+    path = _build_legacy_path(task_name, texts)
+    old_path = path.with_name(f'{path.stem}-old{path.suffix}')
+
+    for source in path, old_path:
+        try:
+            with open(source, 'rb') as file:
+                logging.info('Importing cached %s from %s.',
+                             task_name, source.name)
+                results = msgpack.unpack(file, raw=False)
+        except FileNotFoundError:
+            continue
+
+        distinct = {key: index for index, key in enumerate(keys)
+                    if key not in store}
+        store.add(list(distinct),
+                  [texts[index] for index in distinct.values()],
+                  [results[index] for index in distinct.values()])
+        return
+
+
+def _import_superseded(store: Store, old_store: Store,
+                       keys: list[str], texts: list[str]) -> None:
+    """Move results for these texts from a store the task used to use."""
+    found = {key: text for key, text in zip(keys, texts)
+             if key not in store and key in old_store}
+    if found:
+        found_keys = list(found)
+        logging.info('Moving %d cached results to a new store.', len(found))
+        store.add(found_keys, list(found.values()),
+                  old_store.gather(found_keys, compact=False))
+        old_store.evict(found_keys)
+
+
+_stores: dict[str, Callable[[str], Store]] = {}
+"""How to open the store of each task that ``prune`` may evict results from."""
+
+
+def register(task_name: str, store: Callable[[str], Store]) -> None:
+    """
+    Let ``prune`` evict results from the store of the task with this name.
+
+    ``api_task`` registers the stores of the tasks it decorates. Code that uses
+    a store directly registers it, and calls ``touch`` when it uses results.
+    """
+    _stores[task_name] = store
+
+
+def _access_path(task_name: str) -> Path:
+    """Get the path of the file of access times for a task's store."""
+    return paths.data_dir / f'{task_name}.access'
+
+
+_loaded_access: dict[str, tuple[tuple[int, int, int], dict[str, int]]] = {}
+"""The access times last loaded for each task, and the file status they had."""
+
+
+def _load_access(task_name: str) -> dict[str, int]:
+    """
+    Load the last access times, in whole seconds, of a task's results.
+
+    The times are kept after loading, and reused while the file's status shows
+    it unchanged, so callers must not modify the dict they are given.
+    """
+    try:
+        with open(_access_path(task_name), 'rb') as file:
+            status = os.fstat(file.fileno())
+            version = (status.st_ino, status.st_mtime_ns, status.st_size)
+            with contextlib.suppress(KeyError):
+                loaded_version, times = _loaded_access[task_name]
+                if loaded_version == version:
+                    return times
+            times = msgpack.unpack(file, raw=False)
+    except FileNotFoundError:
+        return {}
+
+    _loaded_access[task_name] = (version, times)
+    return times
+
+
+def touch(task_name: str, keys: Iterable[str]) -> None:
+    """
+    Record that the saved results for these keys of a task were just used.
+
+    Access times are kept in a file beside the store, which is replaced
+    atomically. To keep that cheap, it is only rewritten when some time it
+    holds is more than ``_ACCESS_RESOLUTION`` out of date.
+    """
+    path = _access_path(task_name)
+    now = int(time.time())
+    stale = now - _ACCESS_RESOLUTION.total_seconds()
+
+    with _locked(path):
+        times = _load_access(task_name)
+        touched = [key for key in keys if times.get(key, 0) < stale]
+        if touched:
+            times = {**times, **dict.fromkeys(touched, now)}
+            replace_atomically(path, functools.partial(msgpack.pack, times))
+
+
+def _forget(task_name: str, keys: Collection[str]) -> None:
+    """Remove the access times of evicted results."""
+    path = _access_path(task_name)
+    with _locked(path):
+        times = dict(_load_access(task_name))
+        for key in keys:
+            times.pop(key, None)
+        replace_atomically(path, functools.partial(msgpack.pack, times))
+
+
+def cache_size() -> int:
+    """Get the total size, in bytes, of the files in the data directory."""
+    total = 0
+    with contextlib.suppress(FileNotFoundError):
+        with os.scandir(paths.data_dir) as entries:
+            for entry in entries:
+                with contextlib.suppress(FileNotFoundError):
+                    if entry.is_file():
+                        total += entry.stat().st_size
+    return total
+
+
+def prune(max_bytes: int, *,
+          keep: Optional[Mapping[str, Collection[str]]] = None) -> int:
+    """
+    Evict least recently used results until the cache fits in max_bytes.
+
+    Candidates are the results in registered stores, ordered by the access
+    times ``touch`` recorded (results with no recorded access go first).
+    ``keep`` maps task names to keys whose results must not be evicted.
+
+    Stores are rewritten through temporary files that are renamed into place,
+    so readers never see them half-written. Other files in the data directory,
+    including whole-list files, count toward the total but are never removed.
+    Returns the approximate number of bytes freed.
+    """
+    excess = cache_size() - max_bytes
+    if excess <= 0:
+        return 0
+
+    stores = {task_name: open_store(task_name)
+              for task_name, open_store in _stores.items()}
+    candidates: list[tuple[int, int, str, str]] = []
+
+    for task_name, store in stores.items():
+        times = _load_access(task_name)
+        kept = keep.get(task_name, ()) if keep else ()
+        candidates.extend((times.get(key, 0), size, task_name, key)
+                          for key, size in store.sizes().items()
+                          if key not in kept)
+
+    candidates.sort(key=operator.itemgetter(0))
+    evicted: dict[str, list[str]] = collections.defaultdict(list)
+    freed = 0
+
+    for _, size, task_name, key in candidates:
+        if freed >= excess:
+            break
+        evicted[task_name].append(key)
+        freed += size
+
+    for task_name, keys in evicted.items():
+        logging.info('Evicting %d cached %s.', len(keys), task_name)
+        stores[task_name].evict(keys)
+        _forget(task_name, keys)
+
+    return freed
+
+
+def api_task(
+    task_name: str, *, store: Callable[[str], Store] = RecordStore,
+    checkpoint: Optional[int] = None,
+    supersedes: Optional[Callable[[str], Store]] = None,
+    count_tokens: Optional[Callable[[list[str]], int]] = None,
+) -> TaskDecorator:
+    """
+    Decorator factory to load saved results or query the OpenAI API.
+
+    Results are saved and loaded separately for each text, so the decorated
+    function is only called on texts that have no saved result, and never on
+    the same text twice. Its result must be a sequence with an element for
+    each text. ``store`` is called with the task name to open the cache, which
+    also decides what type of object holds the results the decorator returns.
+    If ``checkpoint`` is given, the function is called on at most that many
+    texts at a time, and each call's results are saved before the next call,
+    so an interrupted run loses at most one call's work. If ``supersedes``
+    is given, it opens a store the task used before, and saved results found
+    there are moved to the new store, instead of being queried again.
+    When a hook is registered in ``metrics``, each call is measured and
+    reported to it, with the tokens sent counted by ``count_tokens``, if it is
+    given. Each call records access times for the results it returns, and if
+    it saved new results while ``paths.cache_limit`` is set, it then calls
+    ``prune`` to evict other results until the cache fits.
+    """
+    register(task_name, store)
+
     def decorator(func: Task[_T]) -> Task[_T]:
         @functools.wraps(func)
         def wrapper(texts: list[str]) -> _T:
-            path = _build_path(task_name, texts)
+            measuring = metrics.enabled()
+            start = time.perf_counter()
+            keys = [build_key(text) for text in texts]
+            cache = store(task_name)
+
+            if not all(key in cache for key in keys):
+                _import_legacy(cache, task_name, keys, texts)
+                if supersedes is not None:
+                    _import_superseded(cache, supersedes(task_name),
+                                       keys, texts)
+
+            missing = {key: text for key, text in zip(keys, texts)
+                       if key not in cache}
+            loaded = saved = time.perf_counter()
+            api_seconds = 0.0
+
+            if missing:
+                ensure_api_key()
+                logging.info('Querying OpenAI %s endpoint for %d of %d texts.',
+                             task_name, len(missing), len(texts))
+                api_seconds = _query_missing(func, cache, missing, checkpoint)
+                saved = time.perf_counter()
+            else:
+                logging.info('Reading cached %s.', task_name)
 
-            with contextlib.suppress(FileNotFoundError):
-                with open(path, 'rb') as file:
-                    logging.info('Reading cached %s.', task_name)
-                    return msgpack.unpack(file, raw=False)  # type: ignore
-                    # FIXME: If not removing msgpack (per issue @97), then
-                    #        deal with this better than "type: ignore".
+            gathered = cache.gather(keys, compact=bool(missing))
 
-            ensure_api_key()
-            logging.info('Querying OpenAI %s endpoint.', task_name)
-            results = func(texts)
+            if measuring:
+                gathered_at = time.perf_counter()
+                metrics.emit(metrics.TaskCall(
+                    task=task_name,
+                    texts=len(texts),
+                    hits=sum(key not in missing for key in keys),
+                    misses=len(missing),
+                    tokens=(count_tokens(list(missing.values()))
+                            if count_tokens is not None and missing else 0),
+                    load_seconds=loaded - start,
+                    api_seconds=api_seconds,
+                    save_seconds=saved - loaded - api_seconds,
+                    gather_seconds=gathered_at - saved,
+                    bytes_read=cache.bytes_read,
+                    bytes_written=cache.bytes_written,
+                ))
 
-            with open(path, 'wb') as file:
-                msgpack.pack(results, file)
+            touch(task_name, keys)
+            if missing and paths.cache_limit is not None:
+                prune(paths.cache_limit, keep={task_name: set(keys)})
 
-            return results
+            return gathered
 
         return wrapper
 
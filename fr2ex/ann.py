@@ -0,0 +1,210 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Approximate nearest-neighbor search over embedded names, for very many names.
+
+This is an inverted file (IVF) index. Spherical k-means partitions the unit
+embeddings into clusters, and each cluster's rows are stored together. A query
+is compared to the cluster centroids, and only the nprobe nearest clusters are
+scanned. Larger nprobe gives better recall at the cost of latency. Scanning all
+clusters is the same as exact search.
+
+New names are assigned to their nearest existing cluster, so they can be added
+without retraining. If very many are added, rebuilding may improve recall.
+"""
+
+from __future__ import annotations
+
+__all__ = ['DEFAULT_PATH', 'IVFIndex']
+
+import functools
+import math
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from fr2ex import _task, embedding, paths
+from fr2ex.search import Index, Match, normalize, top_k
+
+DEFAULT_PATH = paths.data_dir / 'embeddings-ivf.npz'
+"""Where IVFIndex.save and IVFIndex.load keep an index by default."""
+
+_DEFAULT_NPROBE = 8
+"""Default number of clusters to scan per query."""
+
+_ITERATIONS = 10
+"""Number of k-means iterations when building an index."""
+
+_TRAINING_ROWS_PER_CLUSTER = 256
+"""Maximum number of sampled rows, per cluster, to train k-means on."""
+
+_BLOCK_ROWS = 16_384
+"""Number of rows to assign to clusters at a time, bounding memory use."""
+
+
+def _default_cluster_count(row_count: int) -> int:
+    """Pick a number of clusters so centroid and cluster scans are balanced."""
+    return max(1, min(row_count, round(math.sqrt(row_count))))
+
+
+def _assign(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Find the index of the nearest centroid to each row of the matrix."""
+    labels = np.empty(len(matrix), np.intp)
+    for start in range(0, len(matrix), _BLOCK_ROWS):
+        block = matrix[start:start + _BLOCK_ROWS]
+        labels[start:start + len(block)] = (block @ centroids.T).argmax(axis=1)
+    return labels
+
+
+def _train(matrix: np.ndarray, cluster_count: int,
+           rng: np.random.Generator) -> np.ndarray:
+    """Run spherical k-means on a sample of rows, returning unit centroids."""
+    sample_size = min(len(matrix), cluster_count * _TRAINING_ROWS_PER_CLUSTER)
+    sample = matrix[np.sort(rng.choice(len(matrix), sample_size,
+                                       replace=False))]
+    centroids = sample[rng.choice(len(sample), cluster_count, replace=False)]
+
+    for _ in range(_ITERATIONS):
+        labels = _assign(sample, centroids)
+        counts = np.bincount(labels, minlength=cluster_count)
+        starts = np.cumsum(counts) - counts
+        filled = counts != 0
+        sums = np.empty_like(centroids)
+        sums[filled] = np.add.reduceat(sample[np.argsort(labels)],
+                                       starts[filled])
+        # Reseed any cluster that lost all its members with a random row.
+        sums[~filled] = sample[rng.choice(len(sample), (~filled).sum())]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """An inverted file index of names, for approximate cosine similarity."""
+
+    __slots__ = ('_names', '_centroids', '_vectors', '_rows')
+
+    def __init__(self, index: Index, *,
+                 cluster_count: Optional[int] = None,
+                 seed: int = 0) -> None:
+        """
+        Build an IVF index over the names and embeddings of an exact index.
+
+        By default, the number of clusters is about the square root of the
+        number of names. Clustering is randomized, deterministically by the
+        seed.
+        """
+        if cluster_count is None:
+            cluster_count = _default_cluster_count(len(index))
+        if not 0 < cluster_count <= len(index):
+            raise ValueError('need at least one name per cluster')
+
+        self._names = list(index.names)
+        self._centroids = _train(index.matrix, cluster_count,
+                                 np.random.default_rng(seed))
+
+        labels = _assign(index.matrix, self._centroids)
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(cluster_count + 1))
+        self._rows = [order[start:stop]
+                      for start, stop in zip(bounds[:-1], bounds[1:])]
+        self._vectors = [index.matrix[rows] for rows in self._rows]
+
+    @classmethod
+    def load(cls, path: Path = DEFAULT_PATH) -> 'IVFIndex':
+        """Load an index saved by save."""
+        with np.load(path) as data:
+            bounds = data['bounds']
+            vectors = data['vectors']
+            rows = data['rows']
+            ivf = cls.__new__(cls)
+            ivf._names = data['names'].tolist()
+            ivf._centroids = data['centroids']
+            ivf._vectors = [vectors[start:stop]
+                            for start, stop in zip(bounds[:-1], bounds[1:])]
+            ivf._rows = [rows[start:stop]
+                         for start, stop in zip(bounds[:-1], bounds[1:])]
+        return ivf
+
+    def save(self, path: Path = DEFAULT_PATH) -> None:
+        """
+        Save the index, including the names, so load can restore it.
+
+        The file is written under a temporary name and renamed into place, so
+        a concurrent load sees either the old index or the new one.
+        """
+        sizes = [len(rows) for rows in self._rows]
+        _task.replace_atomically(path, functools.partial(
+            np.savez,
+            names=np.array(self._names, dtype=np.str_),
+            centroids=self._centroids,
+            bounds=np.concatenate(([0], np.cumsum(sizes))),
+            vectors=np.concatenate(self._vectors),
+            rows=np.concatenate(self._rows),
+        ))
+
+    def __len__(self) -> int:
+        """The number of names in the index."""
+        return len(self._names)
+
+    @property
+    def names(self) -> list[str]:
+        """The names in the index, in the order they were added."""
+        return self._names
+
+    @property
+    def cluster_count(self) -> int:
+        """The number of clusters the embeddings are partitioned into."""
+        return len(self._centroids)
+
+    def add(self, names: list[str],
+            embeddings: embedding.EmbeddingsMatrix) -> None:
+        """Add names, assigning their embeddings to the nearest clusters."""
+        if len(names) != len(embeddings):
+            raise ValueError(f'got {len(names)} names but '
+                             f'{len(embeddings)} embeddings')
+
+        matrix = normalize(embeddings)
+        labels = _assign(matrix, self._centroids)
+        first_row = len(self._names)
+        self._names.extend(names)
+
+        for cluster in np.unique(labels):
+            members = np.flatnonzero(labels == cluster)
+            self._vectors[cluster] = np.concatenate(
+                (self._vectors[cluster], matrix[members]),
+            )
+            self._rows[cluster] = np.concatenate(
+                (self._rows[cluster], first_row + members),
+            )
+
+    def search(self, vector: embedding.EmbeddingVector, k: int = 5, *,
+               nprobe: int = _DEFAULT_NPROBE,
+               threshold: Optional[float] = None) -> list[Match]:
+        """Find about the k names most similar to an embedding, best first."""
+        query = normalize(vector)
+        nearest = top_k(self._centroids @ query, nprobe)
+        scores = np.concatenate([self._vectors[cluster] @ query
+                                 for cluster in nearest])
+        rows = np.concatenate([self._rows[cluster] for cluster in nearest])
+        return [Match(self._names[rows[position]], float(scores[position]))
+                for position in top_k(scores, k, threshold)]
+
+    def query(self, text: str, k: int = 5, *,
+              nprobe: int = _DEFAULT_NPROBE,
+              threshold: Optional[float] = None) -> list[Match]:
+        """Find about the k names most similar to a text, best first."""
+        return self.search(embedding.embed(text), k,
+                           nprobe=nprobe, threshold=threshold)
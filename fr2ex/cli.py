@@ -0,0 +1,288 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Command-line interface: searching, syncing, cost reporting, and more.
+
+This module imports only what each subcommand needs, when it runs, so that the
+``fr2ex`` command starts quickly. The import-time subcommand measures this.
+"""
+
+__all__ = ['IMPORT_TIME_BUDGET', 'main']
+
+import argparse
+import logging
+from pathlib import Path
+import subprocess
+import sys
+from typing import Optional, Sequence
+
+from fr2ex import paths
+
+IMPORT_TIME_BUDGET = 0.5
+"""Default limit, in seconds, on a cold import of the module checked."""
+
+_DEFAULT_PAIR_THRESHOLD = 0.95
+"""Default similarity at or above which the pairs subcommand reports names."""
+
+_DEFAULT_IMPORT_TIME_MODULE = 'fr2ex.search'
+"""The module import-time checks by default. Searching needs only this."""
+
+
+def _load_names(args: argparse.Namespace) -> list[str]:
+    """Read names from the file given, or sync them from the remote server."""
+    if args.names_file is not None:
+        with open(args.names_file, encoding='utf-8') as file:
+            return [line.strip() for line in file if line.strip()]
+
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import remote
+    return remote.sync_repo_names().names
+
+
+def _search(args: argparse.Namespace) -> int:
+    """Run the search subcommand."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import daemon
+
+    socket_path = args.socket or daemon.default_socket()
+    if args.names_file is None and socket_path.exists():
+        try:
+            matches = daemon.query(args.query, args.k,
+                                   threshold=args.threshold,
+                                   socket_path=socket_path)
+        except (ConnectionError, FileNotFoundError):
+            logging.info('No daemon at %s. Searching directly.', socket_path)
+        except daemon.DaemonError as error:
+            print(f'{Path(sys.argv[0]).name}: query daemon: {error}',
+                  file=sys.stderr)
+            return 1
+        else:
+            for name, score in matches:
+                print(f'{score:.6f}  {name}')
+            return 0
+
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import search
+    index = search.Index.from_names(_load_names(args))
+    for match in index.query(args.query, args.k, threshold=args.threshold):
+        print(f'{match.score:.6f}  {match.name}')
+    return 0
+
+
+def _sync(args: argparse.Namespace) -> int:
+    """Run the sync subcommand."""
+    del args  # The sync subcommand has no options.
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import remote
+
+    changes = remote.sync_repo_names()
+    for name in changes.added:
+        print(f'+ {name}')
+    for name in changes.removed:
+        print(f'- {name}')
+    print(f'{len(changes.names)} repositories, {len(changes.added)} added, '
+          f'{len(changes.removed)} removed.')
+    return 0
+
+
+def _cost(args: argparse.Namespace) -> int:
+    """Run the cost subcommand."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import tokens
+    tokens.report_cost(_load_names(args))
+    return 0
+
+
+def _pairs(args: argparse.Namespace) -> int:
+    """Run the pairs subcommand."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import embedding, pairs
+
+    threshold = args.threshold
+    if threshold is None and args.k is None:
+        threshold = _DEFAULT_PAIR_THRESHOLD
+
+    names = _load_names(args)
+    edges = pairs.similar_pairs(embedding.embed_many(names),
+                                threshold=threshold, k=args.k)
+    if args.clusters:
+        labels = pairs.clusters(edges, len(names))
+        for label, name in zip(labels.tolist(), names):
+            print(f'{label}\t{name}')
+    else:
+        edges.write(sys.stdout, names)
+    return 0
+
+
+def _pipeline(args: argparse.Namespace) -> int:
+    """Run the pipeline subcommand."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import pipeline
+
+    names = None if args.names_file is None else _load_names(args)
+    result = pipeline.run(names)
+    for name in result.flagged:
+        print(f'flagged: {name}')
+    print(f'{len(result.names)} names moderated, {len(result.flagged)} '
+          f'flagged, {len(result.index)} embedded.')
+    return 0
+
+
+def _cache(args: argparse.Namespace) -> int:
+    """Run the cache subcommand."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import _task, embedding, moderation, tokens  # Register stores.
+    del embedding, moderation, tokens
+
+    limit = paths.cache_limit if args.limit is None else args.limit
+    if limit is not None:
+        freed = _task.prune(limit)
+        print(f'{freed} bytes evicted.')
+    print(f'{_task.cache_size()} bytes in {paths.data_dir}.')
+    return 0
+
+
+def _serve(args: argparse.Namespace) -> int:
+    """Run the serve subcommand."""
+    # pylint: disable-next=import-outside-toplevel
+    from fr2ex import daemon
+    daemon.serve(_load_names(args), args.socket)
+    return 0
+
+
+def measure_import_time(module: str) -> float:
+    """Measure how many seconds a fresh interpreter takes to import module."""
+    code = ('import time; start = time.perf_counter(); '
+            f'import {module}; print(time.perf_counter() - start)')
+    result = subprocess.run([sys.executable, '-c', code],
+                            capture_output=True, check=True, text=True)
+    return float(result.stdout)
+
+
+def _import_time(args: argparse.Namespace) -> int:
+    """Run the import-time subcommand."""
+    seconds = measure_import_time(args.module)
+    print(f'Importing {args.module} took {seconds:.3f} s '
+          f'(budget {args.budget:.3f} s).')
+    return 0 if seconds <= args.budget else 1
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    """Build the parser for the command line."""
+    parser = argparse.ArgumentParser(
+        prog='fr2ex',
+        description='Semantic search over repository names.',
+    )
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log progress, including cache and API access')
+    subparsers = parser.add_subparsers(required=True, metavar='COMMAND')
+
+    names_parser = argparse.ArgumentParser(add_help=False)
+    names_parser.add_argument(
+        '--names-file', type=Path, metavar='FILE',
+        help='read names from FILE, one per line, instead of syncing them',
+    )
+
+    socket_parser = argparse.ArgumentParser(add_help=False)
+    socket_parser.add_argument(
+        '--socket', type=Path, metavar='PATH',
+        help=('Unix domain socket of the query daemon '
+              '(default: fr2ex-UID.sock in $XDG_RUNTIME_DIR or the temporary '
+              'directory)'),
+    )
+
+    search_parser = subparsers.add_parser(
+        'search', parents=[names_parser, socket_parser],
+        help='find the names most similar to a query',
+    )
+    search_parser.add_argument('query')
+    search_parser.add_argument('-k', type=int, default=5,
+                               help='how many names to show (default: 5)')
+    search_parser.add_argument('--threshold', type=float,
+                               help='hide names scoring below this')
+    search_parser.set_defaults(func=_search)
+
+    sync_parser = subparsers.add_parser(
+        'sync', help='update the list of names from the remote server',
+    )
+    sync_parser.set_defaults(func=_sync)
+
+    cost_parser = subparsers.add_parser(
+        'cost', parents=[names_parser],
+        help='estimate the cost of embedding all names',
+    )
+    cost_parser.set_defaults(func=_cost)
+
+    pairs_parser = subparsers.add_parser(
+        'pairs', parents=[names_parser],
+        help='find pairs or clusters of near-duplicate names',
+    )
+    pairs_parser.add_argument(
+        '--threshold', type=float,
+        help='keep pairs scoring at least this '
+             f'(default: {_DEFAULT_PAIR_THRESHOLD}, unless -k is given)',
+    )
+    pairs_parser.add_argument('-k', type=int,
+                              help="keep each name's k best neighbors")
+    pairs_parser.add_argument(
+        '--clusters', action='store_true',
+        help='print a cluster number for each name, instead of pairs',
+    )
+    pairs_parser.set_defaults(func=_pairs)
+
+    pipeline_parser = subparsers.add_parser(
+        'pipeline', parents=[names_parser],
+        help='moderate all names and embed those not flagged, resumably',
+    )
+    pipeline_parser.set_defaults(func=_pipeline)
+
+    cache_parser = subparsers.add_parser(
+        'cache', help='show the size of the cache, evicting results if needed',
+    )
+    cache_parser.add_argument(
+        '--limit', type=int,
+        help='evict least recently used results until the cache is at most '
+             'this many bytes (default: FR2EX_CACHE_LIMIT, if set)',
+    )
+    cache_parser.set_defaults(func=_cache)
+
+    serve_parser = subparsers.add_parser(
+        'serve', parents=[names_parser, socket_parser],
+        help='run a query daemon that keeps the index loaded',
+    )
+    serve_parser.set_defaults(func=_serve)
+
+    import_time_parser = subparsers.add_parser(
+        'import-time',
+        help='check how long a cold import takes (exit status 1 if too long)',
+    )
+    import_time_parser.add_argument(
+        '--module', default=_DEFAULT_IMPORT_TIME_MODULE,
+        help='module to import (default: %(default)s)',
+    )
+    import_time_parser.add_argument(
+        '--budget', type=float, default=IMPORT_TIME_BUDGET,
+        help='most seconds the import may take (default: %(default)s)',
+    )
+    import_time_parser.set_defaults(func=_import_time)
+
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Run the command line interface, returning an exit status."""
+    args = _build_parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    return args.func(args)
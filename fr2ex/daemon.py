@@ -0,0 +1,195 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+A long-lived query daemon that keeps a search index loaded, and its client.
+
+The daemon loads the names' embeddings once, keeps them in a search.Index, and
+answers queries over a Unix domain socket. It reloads the embeddings when
+embed_many's cache changes on disk. Query embeddings go through embed, so
+repeated queries are answered from its cache without contacting the API.
+
+The protocol is one JSON object per line in each direction. A request has a
+``query`` string and optionally ``k`` and ``threshold``. A response has either
+``matches``, a list of ``[name, score]`` pairs, best first, or an ``error``.
+
+The client only needs the standard library, so it starts quickly. The daemon's
+heavier dependencies are imported when it starts.
+"""
+
+__all__ = ['DaemonError', 'QueryServer', 'default_socket', 'serve', 'query']
+
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import socketserver
+import tempfile
+import threading
+from typing import Any, Optional
+
+
+class DaemonError(Exception):
+    """
+    The query daemon reported an error, or sent an unusable response.
+
+    This is also raised on starting a daemon where one is already listening.
+    """
+
+
+def default_socket() -> Path:
+    """
+    Get the default path of the Unix domain socket the query daemon uses.
+
+    It is named for the user, in XDG_RUNTIME_DIR if that is set, or else in
+    the temporary directory.
+    """
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return Path(directory) / f'fr2ex-{os.getuid()}.sock'
+
+
+def _is_listening(socket_path: Path) -> bool:
+    """Check if a server accepts connections on a Unix domain socket path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+    return True
+
+
+def _file_signature(path: Path) -> Optional[tuple[int, int, int]]:
+    """Get a tuple that changes when the file is modified or replaced."""
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (status.st_ino, status.st_size, status.st_mtime_ns)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Handler answering each line of JSON sent by a client."""
+
+    server: 'QueryServer'
+
+    def handle(self) -> None:
+        """Answer requests on this connection until the client closes it."""
+        for line in self.rfile:
+            try:
+                response = self.server.answer(json.loads(line))
+            except Exception as error:  # pylint: disable=broad-except
+                logging.exception('Failed to answer a request.')
+                response = {'error': f'{type(error).__name__}: {error}'}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class QueryServer(socketserver.ThreadingUnixStreamServer):
+    """Server answering top-k queries against a search index kept in memory."""
+
+    daemon_threads = True
+
+    def __init__(self, names: list[str],
+                 socket_path: Optional[Path] = None) -> None:
+        """
+        Load the embeddings of the names and listen on the socket path.
+
+        The socket path defaults to default_socket(). A socket file left by a
+        daemon that has exited is replaced. If another daemon is listening on
+        the path, this raises DaemonError instead.
+        """
+        # pylint: disable-next=import-outside-toplevel
+        from fr2ex import embedding
+
+        if socket_path is None:
+            socket_path = default_socket()
+        if _is_listening(socket_path):
+            raise DaemonError(f'a query daemon is already listening on '
+                              f'{socket_path}')
+        if socket_path.is_socket():
+            socket_path.unlink(missing_ok=True)
+
+        self._names = list(names)
+        self._cache_path = embedding.embed_many_cache_path()
+        self._lock = threading.Lock()
+        self._index = self._load()
+        self._signature = _file_signature(self._cache_path)
+
+        super().__init__(str(socket_path), _Handler)
+
+    def answer(self, request: dict[str, Any]) -> dict[str, Any]:
+        """Answer a request decoded from JSON."""
+        # pylint: disable-next=import-outside-toplevel
+        from fr2ex import embedding
+
+        vector = embedding.embed(request['query'])
+        matches = self._current_index().search(
+            vector,
+            int(request.get('k', 5)),
+            threshold=request.get('threshold'),
+        )
+        return {'matches': [[match.name, match.score] for match in matches]}
+
+    def _load(self) -> Any:
+        """Build a search index of the names from embed_many's cache."""
+        # pylint: disable-next=import-outside-toplevel
+        from fr2ex import embedding, search
+
+        logging.info('Loading embeddings of %d names.', len(self._names))
+        return search.Index(self._names, embedding.embed_many(self._names))
+
+    def _current_index(self) -> Any:
+        """Get the index, first reloading it if the cache has changed."""
+        if _file_signature(self._cache_path) == self._signature:
+            return self._index
+
+        with self._lock:
+            signature = _file_signature(self._cache_path)
+            if signature != self._signature:
+                self._index = self._load()
+                self._signature = _file_signature(self._cache_path)
+            return self._index
+
+
+def serve(names: list[str], socket_path: Optional[Path] = None) -> None:
+    """Run a query daemon for the names until interrupted."""
+    if socket_path is None:
+        socket_path = default_socket()
+    with QueryServer(names, socket_path) as server:
+        logging.info('Listening on %s.', socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def query(text: str, k: int = 5, *, threshold: Optional[float] = None,
+          socket_path: Optional[Path] = None) -> list[tuple[str, float]]:
+    """Ask a running query daemon for the k names most similar to text."""
+    if socket_path is None:
+        socket_path = default_socket()
+    request = {'query': text, 'k': k, 'threshold': threshold}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as file:
+            line = file.readline()
+
+    try:
+        response = json.loads(line)
+    except json.JSONDecodeError as error:
+        raise DaemonError('malformed response from query daemon') from error
+    if 'error' in response:
+        raise DaemonError(response['error'])
+    return [(str(name), float(score)) for name, score in response['matches']]
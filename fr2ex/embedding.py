@@ -18,40 +18,305 @@ The text embeddings computed are computed with OpenAI's new (in December 2022)
 model text-embedding-ada-002.
 """
 
-__all__ = ['EmbeddingsMatrix', 'embed', 'embed_many']
+from __future__ import annotations
 
-from nptyping import Float32, NDArray, Shape, assert_isinstance
+__all__ = [
+    'MODEL',
+    'DIMENSIONS',
+    'QUERY_CACHE_SIZE',
+    'MAX_CONCURRENT_REQUESTS',
+    'EmbeddingsMatrix',
+    'CacheInfo',
+    'embed',
+    'embed_cache_info',
+    'embed_cache_clear',
+    'embed_many',
+    'embed_many_cache_path',
+]
+
+import collections
+import functools
+import math
+from pathlib import Path
+import threading
+from typing import TYPE_CHECKING, Any
+
+import attrs
 import numpy as np
-import openai.embeddings_utils
 
-from fr2ex import _task
+from fr2ex import _task, tokens
 
-EmbeddingVector = NDArray[Shape['1536'], Float32]
-"""An embedding in a 1536-dimensional space."""
+if TYPE_CHECKING:
+    from nptyping import Float32, NDArray, Shape
 
-EmbeddingsMatrix = NDArray[Shape['*, 1536'], Float32]
-"""A matrix whose rows are embeddings in a 1536-dimensional space."""
+MODEL = 'text-embedding-ada-002'
+"""The OpenAI model that computes the embeddings."""
 
+DIMENSIONS = 1536
+"""The number of dimensions in the space the embeddings are in."""
 
-def embed(text: str) -> EmbeddingVector:
+# nptyping is slow to import, so at runtime these are built on first access,
+# by _nptyping_aliases. Annotations in this module are not evaluated.
+if TYPE_CHECKING:
+    EmbeddingVector = NDArray[Shape['1536'], Float32]
+    """An embedding in a 1536-dimensional space."""
+
+    EmbeddingsMatrix = NDArray[Shape['*, 1536'], Float32]
+    """A matrix whose rows are embeddings in a 1536-dimensional space."""
+
+QUERY_CACHE_SIZE = 1024
+"""Maximum number of embeddings embed keeps in memory (not on disk)."""
+
+_QUERY_TASK_NAME = 'queries'
+"""Name of the store where embed saves embeddings on disk."""
+
+_MANY_TASK_NAME = 'embeddings'
+"""Name of the store where embed_many saves embeddings on disk."""
+
+MAX_CONCURRENT_REQUESTS = 8
+"""Maximum number of requests embed_many has in flight at once."""
+
+_MAX_BATCH_SIZE = 2048
+"""Maximum number of texts the API accepts in a single request."""
+
+_MIN_BATCH_SIZE = 64
+"""Number of texts below which embed_many doesn't split batches further."""
+
+_MAX_BATCH_TOKENS = 100_000
+"""Maximum total number of tokens embed_many sends in a single request."""
+
+_CHECKPOINT_SIZE = 16_384
+"""Number of texts embed_many embeds, concurrently, between saves."""
+
+
+@functools.cache
+def _nptyping_aliases() -> dict[str, Any]:
+    """Build the nptyping types EmbeddingVector and EmbeddingsMatrix."""
+    # pylint: disable=redefined-outer-name,reimported
+    # pylint: disable-next=import-outside-toplevel
+    from nptyping import Float32, NDArray, Shape
+    return {
+        'EmbeddingVector': NDArray[Shape['1536'], Float32],
+        'EmbeddingsMatrix': NDArray[Shape['*, 1536'], Float32],
+    }
+
+
+def __getattr__(name: str) -> Any:
+    """Get EmbeddingVector or EmbeddingsMatrix, building them if needed."""
+    try:
+        return _nptyping_aliases()[name]
+    except KeyError:
+        raise AttributeError(
+            f'module {__name__!r} has no attribute {name!r}',
+        ) from None
+
+
+def _assert_isinstance(array: np.ndarray, type_name: str) -> None:
+    """Check that an array is an instance of one of our nptyping types."""
+    # pylint: disable-next=import-outside-toplevel
+    from nptyping import assert_isinstance
+    assert_isinstance(array, _nptyping_aliases()[type_name])
+
+
+@attrs.frozen
+class CacheInfo:
+    """Statistics for the caches of single embeddings computed by embed."""
+
+    memory_hits: int
+    """Number of calls that found the embedding in memory."""
+
+    disk_hits: int
+    """Number of calls that found the embedding on disk, but not in memory."""
+
+    misses: int
+    """Number of calls that had to query the API."""
+
+    size: int
+    """Number of embeddings currently held in memory."""
+
+    max_size: int
+    """Number of embeddings that can be held in memory."""
+
+
+class _QueryCache:
+    """Two-level cache for embed: an LRU in memory, over a store on disk."""
+
+    __slots__ = ('_max_size', '_lock', '_vectors',
+                 '_memory_hits', '_disk_hits', '_misses')
+
+    def __init__(self, max_size: int) -> None:
+        """Create an empty cache holding up to max_size vectors in memory."""
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._vectors: collections.OrderedDict[str, EmbeddingVector] = (
+            collections.OrderedDict()
+        )
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+    def get(self, text: str) -> EmbeddingVector:
+        """Get an embedding from memory, or from disk, or from the API."""
+        with self._lock:
+            try:
+                vector = self._vectors[text]
+            except KeyError:
+                pass
+            else:
+                self._vectors.move_to_end(text)
+                self._memory_hits += 1
+                return vector
+
+        vector = self._load_or_query(text)
+        vector.flags.writeable = False
+
+        with self._lock:
+            self._vectors[text] = vector
+            self._vectors.move_to_end(text)
+            while len(self._vectors) > self._max_size:
+                self._vectors.popitem(last=False)
+
+        return vector
+
+    def info(self) -> CacheInfo:
+        """Report hit and miss counts and the current and maximum sizes."""
+        with self._lock:
+            return CacheInfo(
+                memory_hits=self._memory_hits,
+                disk_hits=self._disk_hits,
+                misses=self._misses,
+                size=len(self._vectors),
+                max_size=self._max_size,
+            )
+
+    def clear(self) -> None:
+        """Clear the memory cache and statistics. The disk cache is kept."""
+        with self._lock:
+            self._vectors.clear()
+            self._memory_hits = self._disk_hits = self._misses = 0
+
+    def _load_or_query(self, text: str) -> EmbeddingVector:
+        """Get an embedding from the disk store, or query and save it there."""
+        key = _task.build_key(text)
+        store = _task.ArrayStore(_QUERY_TASK_NAME,
+                                 model=MODEL, dim=DIMENSIONS)
+
+        if key in store:
+            with self._lock:
+                self._disk_hits += 1
+            _task.touch(_QUERY_TASK_NAME, [key])
+            return np.array(store.gather([key], compact=False)[0])
+
+        with self._lock:
+            self._misses += 1
+        vector = _query_one(text)
+        store.add([key], [text], vector[np.newaxis])
+        _task.touch(_QUERY_TASK_NAME, [key])
+        return vector
+
+
+_query_cache = _QueryCache(QUERY_CACHE_SIZE)
+"""The cache embed uses."""
+
+_task.register(_QUERY_TASK_NAME, functools.partial(
+    _task.ArrayStore, model=MODEL, dim=DIMENSIONS,
+))
+
+
+def _query_one(text: str) -> EmbeddingVector:
     """Query the API for text-embedding-ada-002 for the text. No caching."""
+    # pylint: disable-next=import-outside-toplevel
+    import openai.embeddings_utils
     _task.ensure_api_key()
     embedding = openai.embeddings_utils.get_embedding(
         text=text,
-        engine='text-embedding-ada-002',
+        engine=MODEL,
     )
     column_vector = np.array(embedding, np.float32)
-    assert_isinstance(column_vector, EmbeddingVector)
+    _assert_isinstance(column_vector, 'EmbeddingVector')
     return column_vector
 
 
-@_task.api_task('embeddings')
+def embed(text: str) -> EmbeddingVector:
+    """
+    Load or query the API for text-embedding-ada-002 for the text.
+
+    Recently used embeddings are kept in memory, up to QUERY_CACHE_SIZE of
+    them. All embeddings computed this way are also saved on disk, keyed by a
+    hash of the text, in a store whose header records the model. So repeated
+    queries need not access the API, even across processes.
+    """
+    return _query_cache.get(text)
+
+
+def embed_cache_info() -> CacheInfo:
+    """Report statistics for the caches used by embed."""
+    return _query_cache.info()
+
+
+def embed_cache_clear() -> None:
+    """Clear embed's memory cache and statistics, but not its disk cache."""
+    _query_cache.clear()
+
+
+def _embed_batch(texts: list[str]) -> list[list[float]]:
+    """Query the API for text-embedding-ada-002 for one batch of texts."""
+    # pylint: disable-next=import-outside-toplevel
+    import openai
+    response = openai.Embedding.create(
+        # Replace newlines, as openai.embeddings_utils.get_embeddings does.
+        input=[text.replace('\n', ' ') for text in texts],
+        engine=MODEL,
+    )
+    data = sorted(response['data'], key=lambda item: item['index'])
+    return [item['embedding'] for item in data]
+
+
+def _plan_batches(texts: list[str]) -> list[list[str]]:
+    """
+    Split texts into batches by their cl100k_base token counts.
+
+    Batches are also made small enough to spread a list across all concurrent
+    requests, so long as that doesn't make them smaller than _MIN_BATCH_SIZE.
+    """
+    spread = math.ceil(len(texts) / MAX_CONCURRENT_REQUESTS)
+    ranges = _task.plan_batches(
+        tokens.count_each(texts),
+        max_count=min(max(spread, _MIN_BATCH_SIZE), _MAX_BATCH_SIZE),
+        max_weight=_MAX_BATCH_TOKENS,
+    )
+    return [texts[batch.start:batch.stop] for batch in ranges]
+
+
+@_task.api_task(_MANY_TASK_NAME, store=functools.partial(
+    _task.ArrayStore, model=MODEL, dim=DIMENSIONS,
+), checkpoint=_CHECKPOINT_SIZE, count_tokens=tokens.count)
 def embed_many(texts: list[str]) -> EmbeddingsMatrix:
-    """Load or query the API for text-embedding-ada-002 for all texts."""
-    embeddings = openai.embeddings_utils.get_embeddings(
-        list_of_text=texts,
-        engine='text-embedding-ada-002',
+    """
+    Load or query the API for text-embedding-ada-002 for all texts.
+
+    Cached embeddings are memory-mapped, so when they are all saved, and were
+    saved in this order, the result is a read-only view of the cache file.
+
+    Texts not yet cached are sent in batches planned from their token counts,
+    with up to MAX_CONCURRENT_REQUESTS requests in flight. Each batch is
+    retried separately if rate-limited. Embeddings are saved after every
+    _CHECKPOINT_SIZE texts, so an interrupted call keeps most of its work.
+
+    The API is reached through the openai module's configuration, so setting
+    ``openai.api_base`` directs requests to a local stand-in for the endpoint.
+    """
+    batches = _task.map_concurrently(
+        _embed_batch,
+        _plan_batches(texts),
+        max_workers=MAX_CONCURRENT_REQUESTS,
     )
-    matrix = np.array(embeddings, np.float32)
-    assert_isinstance(matrix, EmbeddingsMatrix)
+    matrix = np.array([row for batch in batches for row in batch], np.float32)
+    matrix = matrix.reshape(len(texts), DIMENSIONS)
+    _assert_isinstance(matrix, 'EmbeddingsMatrix')
     return matrix
+
+
+def embed_many_cache_path() -> Path:
+    """The file that changes whenever embed_many's cache on disk changes."""
+    return _task.ArrayStore.index_path(_MANY_TASK_NAME)
@@ -0,0 +1,308 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Lexical search by substring frequencies, like findrepo, and hybrid search.
+
+Like findrepo, a LexicalIndex treats each name as a sparse vector of how often
+each substring occurs in it (case-insensitively), and scores names by cosine
+similarity to the query's vector. Substrings shorter than three characters are
+left out: so many names share them that they would cost the most to score,
+while telling the least. Long substrings are left out because they add little
+once their shorter substrings match. A query too short to have any indexed
+substrings is scored by how much of each name containing it it covers.
+
+The index is inverted: each substring maps to the names that contain it, with
+their counts. So a query only touches names that share a substring with it,
+and its cost depends on how many there are, not on how many names there are.
+
+A HybridIndex combines these lexical scores with the semantic scores of an
+embedding Index, so that one ranking can reward guesses that share part of a
+name and guesses that only share its meaning.
+"""
+
+from __future__ import annotations
+
+__all__ = ['LexicalIndex', 'HybridIndex']
+
+import collections
+import itertools
+import math
+from typing import Iterator, Optional
+
+import numpy as np
+
+from fr2ex import embedding
+from fr2ex.search import Index, Match, top_k
+
+_MIN_LENGTH = 3
+"""Length of the shortest substrings indexed."""
+
+_MAX_LENGTH = 8
+"""Length of the longest substrings indexed."""
+
+_DEFAULT_LEXICAL_WEIGHT = 0.5
+"""Default weight HybridIndex gives lexical scores. Semantic get the rest."""
+
+
+def _substring_counts(text: str) -> collections.Counter[str]:
+    """Count each indexed substring of the case-folded text."""
+    folded = text.casefold()
+    return collections.Counter(
+        folded[start:start + length]
+        for length in range(_MIN_LENGTH, _MAX_LENGTH + 1)
+        for start in range(len(folded) - length + 1)
+    )
+
+
+def _code_points(text: str) -> np.ndarray:
+    """Get the code points of a string, as an array."""
+    return np.frombuffer(text.encode('utf-32-le'), np.uint32)
+
+
+def _as_keys(windows: np.ndarray) -> np.ndarray:
+    """View rows of code points as keys that compare and sort as a whole."""
+    windows = np.ascontiguousarray(windows)
+    dtype = np.dtype((np.void, windows.shape[1] * windows.itemsize))
+    return windows.view(dtype)[:, 0]
+
+
+def _substring_pairs(folded: list[str]) -> tuple[list[np.ndarray], np.ndarray]:
+    """
+    Find each length's distinct substrings, and where they occur.
+
+    This works on the code points of all the texts at once, one substring
+    length at a time, with array operations. It returns each length's distinct
+    substrings as a sorted array of keys, to binary search, and the substring
+    number and row of each occurrence, encoded as substring * rows + row.
+    """
+    count = len(folded)
+    lengths = np.fromiter(map(len, folded), np.intp, count)
+    codes = _code_points(''.join(folded))
+    rows = np.repeat(np.arange(count), lengths)
+    room = np.repeat(np.cumsum(lengths), lengths) - np.arange(len(codes))
+
+    all_keys = []
+    pair_parts = []
+    offset = 0
+    for length in range(_MIN_LENGTH, _MAX_LENGTH + 1):
+        starts = np.flatnonzero(room >= length)  # Room for the substring.
+        windows = codes[starts[:, np.newaxis] + np.arange(length)]
+        keys, ids = np.unique(_as_keys(windows), return_inverse=True)
+        all_keys.append(keys)
+        pair_parts.append((ids.reshape(-1) + offset) * count + rows[starts])
+        offset += len(keys)
+
+    return all_keys, np.concatenate(pair_parts)
+
+
+class LexicalIndex:
+    """An inverted index of substrings of names, for findrepo-style search."""
+
+    __slots__ = ('_names', '_folded', '_unindexed', '_keys', '_bounds',
+                 '_postings', '_weights')
+
+    def __init__(self, names: list[str]) -> None:
+        """Index all names."""
+        self._names = list(names)
+        self._folded = [name.casefold() for name in self._names]
+        count = len(self._folded)
+        self._unindexed = np.flatnonzero([
+            0 < len(name) < _MIN_LENGTH for name in self._folded
+        ])
+        self._keys, pairs = _substring_pairs(self._folded)
+
+        # Sorting (substring, row) pairs groups them into posting lists, in
+        # row order, and counts how often each substring is in each name.
+        pairs, counts = np.unique(pairs, return_counts=True)
+        postings = pairs % max(count, 1)
+        norms = np.sqrt(np.bincount(postings, weights=counts * counts,
+                                    minlength=count))
+
+        # Postings are stored in the types np.bincount works in, so queries
+        # don't convert them.
+        self._bounds = np.searchsorted(
+            pairs // max(count, 1),
+            np.arange(sum(map(len, self._keys)) + 1),
+        )
+        self._postings = postings
+        self._weights = counts / norms[postings]
+
+    def __len__(self) -> int:
+        """The number of names in the index."""
+        return len(self._names)
+
+    @property
+    def names(self) -> list[str]:
+        """The names in the index, in the order they were given."""
+        return self._names
+
+    def matches(self, text: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the names that share a substring with the text, and their scores.
+
+        This returns ascending rows and their cosine similarities. It takes
+        time in proportion to the postings of the text's substrings, not to
+        the number of names. Texts shorter than the shortest substrings
+        indexed have none. Instead, names containing them are scored by the
+        fraction of the name that occurrences of the text cover.
+        """
+        counts = _substring_counts(text)
+        if not counts:
+            return self._short_matches(text.casefold())
+
+        posting_lists = []
+        weight_lists = []
+        for start, stop, multiplicity in self._segments(counts):
+            posting_lists.append(self._postings[start:stop])
+            weights = self._weights[start:stop]
+            weight_lists.append(weights if multiplicity == 1
+                                else weights * multiplicity)
+
+        if not posting_lists:
+            return np.empty(0, np.intp), np.empty(0, np.float32)
+
+        # Sum each row's weights. The rows with postings are the candidates;
+        # the rest score zero.
+        dots = np.bincount(np.concatenate(posting_lists),
+                           np.concatenate(weight_lists),
+                           minlength=len(self._names))
+        rows = np.flatnonzero(dots != 0)  # Faster than testing floats.
+        query_norm = math.sqrt(sum(count * count for count in counts.values()))
+        return rows, (dots[rows] / query_norm).astype(np.float32)
+
+    def scores(self, text: str) -> np.ndarray:
+        """Compute the cosine similarity of every name's substring counts."""
+        rows, scores = self.matches(text)
+        dense = np.zeros(len(self._names), np.float32)
+        dense[rows] = scores
+        return dense
+
+    def search(self, text: str, k: int = 5, *,
+               threshold: Optional[float] = None) -> list[Match]:
+        """
+        Find the k names whose substrings best match the text's.
+
+        Only names sharing a substring with the text are found, so there may
+        be fewer than k.
+        """
+        rows, scores = self.matches(text)
+        return [Match(self._names[rows[best]], float(scores[best]))
+                for best in top_k(scores, k, threshold)]
+
+    def _segments(self, counts: collections.Counter[str],
+                  ) -> Iterator[tuple[int, int, int]]:
+        """
+        Find where the indexed substrings' posting lists start and stop.
+
+        Each length's substrings are binary searched for at once. Each posting
+        list's bounds are yielded with how often its substring was counted.
+        """
+        groups: list[list[str]] = [[] for _ in self._keys]
+        for substring in counts:
+            groups[len(substring) - _MIN_LENGTH].append(substring)
+
+        offsets = itertools.accumulate(map(len, self._keys), initial=0)
+        for length, keys, offset, substrings in zip(
+                itertools.count(_MIN_LENGTH), self._keys, offsets, groups):
+            if not substrings or keys.size == 0:
+                continue
+            wanted = _as_keys(_code_points(''.join(substrings))
+                              .reshape(len(substrings), length))
+            positions = np.searchsorted(keys, wanted)
+            positions[positions == len(keys)] = 0
+            found = keys[positions] == wanted
+            ids = positions[found] + offset
+            yield from zip(
+                self._bounds[ids].tolist(),
+                self._bounds[ids + 1].tolist(),
+                itertools.compress(map(counts.__getitem__, substrings),
+                                   found.tolist()),
+            )
+
+    def _short_matches(self, folded: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find names containing a text too short to have been indexed.
+
+        The candidates are the names with a shortest indexed substring that
+        contains the text, and the names too short to have one.
+        """
+        if not folded:
+            return np.empty(0, np.intp), np.empty(0, np.float32)
+
+        keys = self._keys[0]
+        windows = keys.view(np.uint32).reshape(len(keys), _MIN_LENGTH)
+        wanted = _code_points(folded)
+        found = np.zeros(len(keys), bool)
+        for start in range(_MIN_LENGTH - len(wanted) + 1):
+            found |= (windows[:, start:start + len(wanted)] == wanted).all(1)
+
+        candidates = np.unique(np.concatenate([self._unindexed] + [
+            self._postings[self._bounds[key]:self._bounds[key + 1]]
+            for key in np.flatnonzero(found).tolist()
+        ]))
+        coverage = np.fromiter(
+            (self._folded[row].count(folded) * len(folded)
+             / len(self._folded[row]) for row in candidates.tolist()),
+            np.float32, len(candidates),
+        )
+        nonzero = coverage != 0
+        return candidates[nonzero], coverage[nonzero]
+
+
+class HybridIndex:
+    """Search ranking names by a blend of lexical and semantic similarity."""
+
+    __slots__ = ('_semantic', '_lexical', '_lexical_weight')
+
+    def __init__(self, semantic: Index,
+                 lexical: Optional[LexicalIndex] = None, *,
+                 lexical_weight: float = _DEFAULT_LEXICAL_WEIGHT) -> None:
+        """
+        Combine an embedding index with a lexical index of the same names.
+
+        If no lexical index is given, one is built from the semantic index's
+        names. Scores are lexical_weight times the lexical score plus the rest
+        of the weight times the semantic score.
+        """
+        if lexical is None:
+            lexical = LexicalIndex(semantic.names)
+        elif lexical.names != semantic.names:
+            raise ValueError('indices must have the same names in order')
+        if not 0 <= lexical_weight <= 1:
+            raise ValueError('lexical weight must be between 0 and 1')
+
+        self._semantic = semantic
+        self._lexical = lexical
+        self._lexical_weight = lexical_weight
+
+    def scores(self, text: str,
+               vector: Optional[embedding.EmbeddingVector] = None,
+               ) -> np.ndarray:
+        """Compute each name's blended score. Embeds the text if needed."""
+        if vector is None:
+            vector = embedding.embed(text)
+        lexical = self._lexical.scores(text)
+        semantic = self._semantic.scores(vector)
+        return (self._lexical_weight * lexical
+                + (1 - self._lexical_weight) * semantic)
+
+    def query(self, text: str, k: int = 5, *,
+              threshold: Optional[float] = None,
+              vector: Optional[embedding.EmbeddingVector] = None,
+              ) -> list[Match]:
+        """Find the k names with the best blended scores, best first."""
+        scores = self.scores(text, vector)
+        names = self._semantic.names
+        return [Match(names[row], float(scores[row]))
+                for row in top_k(scores, k, threshold)]
@@ -0,0 +1,242 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Metrics on calls to API tasks, such as embed_many and get_moderation.
+
+Each call to a function decorated by ``_task.api_task`` can be described by a
+TaskCall record: how long each phase took, how many bytes its cache read and
+wrote, how many texts were cached or sent to the API, and how many tokens were
+sent. Records are passed to every registered hook. An Aggregator is a hook
+that keeps totals for each task. Any other callable taking a TaskCall can be a
+hook too, such as one that exports records to a telemetry system.
+
+When no hook is registered, nothing is measured, so the cost is one check.
+"""
+
+__all__ = [
+    'Outcome',
+    'TaskCall',
+    'TaskTotals',
+    'Hook',
+    'Aggregator',
+    'add_hook',
+    'remove_hook',
+    'hooked',
+    'enabled',
+    'emit',
+]
+
+import contextlib
+import threading
+from typing import Callable, Iterator, Literal
+
+import attrs
+
+Outcome = Literal['hit', 'partial', 'miss']
+"""Whether a call found all, some, or none of its results in the cache."""
+
+
+@attrs.frozen
+class TaskCall:  # pylint: disable=too-many-instance-attributes
+    """Measurements of one call to an API task."""
+
+    task: str
+    """The name of the task, which is also the name of its cache."""
+
+    texts: int
+    """Number of texts the call was given."""
+
+    hits: int
+    """Number of those texts whose results were already cached."""
+
+    misses: int
+    """Number of distinct texts sent to the API."""
+
+    tokens: int
+    """Number of cl100k_base tokens in the texts sent, if the task counts."""
+
+    load_seconds: float
+    """Time taken to open the cache and look up the texts."""
+
+    api_seconds: float
+    """Time taken by the API requests, including retries."""
+
+    save_seconds: float
+    """Time taken to save new results to the cache."""
+
+    gather_seconds: float
+    """Time taken to collect the results from the cache."""
+
+    bytes_read: int
+    """Bytes the cache read from its files, including results handed out."""
+
+    bytes_written: int
+    """Bytes the cache wrote to its files."""
+
+    @property
+    def outcome(self) -> Outcome:
+        """Whether all, some, or none of the results were cached."""
+        if self.misses == 0:
+            return 'hit'
+        if self.hits == 0:
+            return 'miss'
+        return 'partial'
+
+    @property
+    def seconds(self) -> float:
+        """Total time taken by the call."""
+        return (self.load_seconds + self.api_seconds + self.save_seconds
+                + self.gather_seconds)
+
+
+@attrs.frozen
+class TaskTotals:  # pylint: disable=too-many-instance-attributes
+    """Sums of measurements over the calls to one API task."""
+
+    calls: int = 0
+    """Number of calls."""
+
+    texts: int = 0
+    """Number of texts given, over all calls."""
+
+    hits: int = 0
+    """Number of texts whose results were already cached."""
+
+    misses: int = 0
+    """Number of distinct texts sent to the API, summed over calls."""
+
+    tokens: int = 0
+    """Number of cl100k_base tokens sent to the API."""
+
+    load_seconds: float = 0.0
+    """Time taken opening the cache and looking up texts."""
+
+    api_seconds: float = 0.0
+    """Time taken by API requests."""
+
+    save_seconds: float = 0.0
+    """Time taken saving new results."""
+
+    gather_seconds: float = 0.0
+    """Time taken collecting results."""
+
+    bytes_read: int = 0
+    """Bytes the cache read."""
+
+    bytes_written: int = 0
+    """Bytes the cache wrote."""
+
+    @property
+    def hit_ratio(self) -> float:
+        """Fraction of texts whose results were cached, or NaN if no texts."""
+        return self.hits / self.texts if self.texts else float('nan')
+
+    @property
+    def seconds(self) -> float:
+        """Total time taken by the calls."""
+        return (self.load_seconds + self.api_seconds + self.save_seconds
+                + self.gather_seconds)
+
+    def add(self, call: TaskCall) -> 'TaskTotals':
+        """Make totals that also include one more call."""
+        return TaskTotals(
+            calls=self.calls + 1,
+            texts=self.texts + call.texts,
+            hits=self.hits + call.hits,
+            misses=self.misses + call.misses,
+            tokens=self.tokens + call.tokens,
+            load_seconds=self.load_seconds + call.load_seconds,
+            api_seconds=self.api_seconds + call.api_seconds,
+            save_seconds=self.save_seconds + call.save_seconds,
+            gather_seconds=self.gather_seconds + call.gather_seconds,
+            bytes_read=self.bytes_read + call.bytes_read,
+            bytes_written=self.bytes_written + call.bytes_written,
+        )
+
+
+Hook = Callable[[TaskCall], None]
+"""A callable that is given a TaskCall record after each call to a task."""
+
+
+class Aggregator:
+    """Hook that keeps totals of the measurements of each task's calls."""
+
+    __slots__ = ('_lock', '_totals')
+
+    def __init__(self) -> None:
+        """Create an aggregator with no calls recorded."""
+        self._lock = threading.Lock()
+        self._totals: dict[str, TaskTotals] = {}
+
+    def __call__(self, call: TaskCall) -> None:
+        """Add a call to the totals for its task."""
+        with self._lock:
+            self._totals[call.task] = (
+                self._totals.get(call.task, TaskTotals()).add(call)
+            )
+
+    @property
+    def totals(self) -> dict[str, TaskTotals]:
+        """Totals so far, by task name."""
+        with self._lock:
+            return dict(self._totals)
+
+    def reset(self) -> None:
+        """Discard all totals."""
+        with self._lock:
+            self._totals.clear()
+
+
+_hooks: list[Hook] = []
+"""The registered hooks. This is replaced, never mutated, when changed."""
+
+_hooks_lock = threading.Lock()
+"""Mutex for changing the registered hooks."""
+
+
+def add_hook(hook: Hook) -> None:
+    """Register a hook to be given a record of each call to an API task."""
+    global _hooks  # pylint: disable=global-statement
+    with _hooks_lock:
+        _hooks = [*_hooks, hook]
+
+
+def remove_hook(hook: Hook) -> None:
+    """Unregister a hook. It must have been registered."""
+    global _hooks  # pylint: disable=global-statement
+    with _hooks_lock:
+        hooks = list(_hooks)
+        hooks.remove(hook)
+        _hooks = hooks
+
+
+@contextlib.contextmanager
+def hooked(hook: Hook) -> Iterator[Hook]:
+    """Register a hook for the duration of a block."""
+    add_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+
+
+def enabled() -> bool:
+    """Check if any hook is registered, so calls should be measured."""
+    return bool(_hooks)
+
+
+def emit(call: TaskCall) -> None:
+    """Give a record of a call to every registered hook."""
+    for hook in _hooks:
+        hook(call)
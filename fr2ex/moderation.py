@@ -51,20 +51,52 @@ should be fine. But it is important to keep in mind:
 __all__ = [
     'Categories',
     'CategoryScores',
+    'CATEGORIES',
+    'MAX_CONCURRENT_REQUESTS',
     'Result',
+    'Table',
     'any_flagged',
     'get_moderation',
 ]
 
-from typing import Any, TypedDict, cast
+import logging
+import math
+from typing import (
+    Any,
+    Iterator,
+    Mapping,
+    Sequence,
+    TypedDict,
+    Union,
+    cast,
+    overload,
+)
 
-import more_itertools
-import openai
+import attrs
+import numpy as np
 
-from fr2ex import _task
+from fr2ex import _task, tokens
 
-_CHUNK_SIZE = 32
-"""Number of moderations to retrieve per API request."""
+MAX_CONCURRENT_REQUESTS = 8
+"""Maximum number of requests get_moderation has in flight at once."""
+
+_MAX_CHUNK_SIZE = 32
+"""Maximum number of moderations to retrieve per API request."""
+
+_MIN_CHUNK_SIZE = 4
+"""Number of texts below which get_moderation doesn't split chunks further."""
+
+_MAX_CHUNK_LENGTH = 32_000
+"""Maximum total length, in characters, of the texts in one API request."""
+
+_CHECKPOINT_SIZE = 1024
+"""Number of texts get_moderation moderates, concurrently, between saves."""
+
+_TASK_NAME = 'moderation'
+"""Name of the task whose results get_moderation caches."""
+
+_MODEL = 'text-moderation-latest'
+"""The moderation model, recorded in the cache's header."""
 
 
 Categories = TypedDict('Categories', {
@@ -99,6 +131,19 @@ CategoryScores = TypedDict('CategoryScores', {
 """Each moderation category and the score for that category."""
 
 
+CATEGORIES: tuple[str, ...] = tuple(Categories.__annotations__)
+"""The moderation categories, in the order of the columns of a Table."""
+
+_COLUMNS = {category: column for column, category in enumerate(CATEGORIES)}
+"""The column of each category in a Table."""
+
+_ROW_WIDTH = 2 * len(CATEGORIES) + 1
+"""Width of a cached row: each category's score, then its flag, then flagged.
+
+Flags are stored as 0.0 or 1.0, so a row fits in an ArrayStore.
+"""
+
+
 class Result(TypedDict):
     """Result data, for a single text, from the OpenAI moderation endpoint."""
 
@@ -128,9 +173,213 @@ def any_flagged(result: Result) -> bool:
     return any(result['categories'].values())
 
 
-@_task.api_task('moderation')
-def get_moderation(texts: list[str]) -> list[Result]:
-    """Load or query the API for a list of moderation results for all texts."""
-    chunks = more_itertools.chunked(texts, _CHUNK_SIZE)
-    moderations = (openai.Moderation.create(input=chunk) for chunk in chunks)
-    return [result for mod in moderations for result in cast(Any, mod).results]
+@attrs.frozen(eq=False)
+class Table:
+    """
+    Moderation results for many texts, as arrays with a row for each text.
+
+    Each category is a column, in the order of CATEGORIES, so questions about
+    many results, such as which texts are flagged in some category or score
+    above some threshold, are answered by whole-array operations instead of
+    by walking dicts. Scores are float32, and are NaN in categories that the
+    API did not report when a result was saved. Categories the API reports
+    that are not in CATEGORIES have no column, and are logged when dropped.
+
+    Indexing with an int gives one result, in the format the API returns.
+    Indexing with a slice gives a table of those rows.
+    """
+
+    names: list[str]
+    """The texts the results are for, in the order of the rows."""
+
+    flags: np.ndarray
+    """Whether each category is flagged for each text, as a bool matrix."""
+
+    scores: np.ndarray
+    """The score of each category for each text, as a float32 matrix."""
+
+    flagged: np.ndarray
+    """Whether each text was considered flagged, as a bool vector."""
+
+    @classmethod
+    def from_rows(cls, names: list[str], rows: np.ndarray) -> 'Table':
+        """Make a table from rows in the format get_moderation caches."""
+        count = len(CATEGORIES)
+        return cls(names=names,
+                   flags=rows[:, count:2 * count] != 0,
+                   scores=rows[:, :count],
+                   flagged=rows[:, 2 * count] != 0)
+
+    def __len__(self) -> int:
+        """The number of results."""
+        return len(self.names)
+
+    @overload
+    def __getitem__(self, row: int) -> Result: ...
+
+    @overload
+    def __getitem__(self, row: slice) -> 'Table': ...
+
+    def __getitem__(self, row: Union[int, slice]) -> Union[Result, 'Table']:
+        """Get the result in one row, or a table of the rows in a slice."""
+        if isinstance(row, slice):
+            return Table(names=self.names[row],
+                         flags=self.flags[row],
+                         scores=self.scores[row],
+                         flagged=self.flagged[row])
+        return {
+            'categories': cast(Categories, dict(
+                zip(CATEGORIES, self.flags[row].tolist()),
+            )),
+            'category_scores': cast(CategoryScores, dict(
+                zip(CATEGORIES, self.scores[row].tolist()),
+            )),
+            'flagged': bool(self.flagged[row]),
+        }
+
+    def __iter__(self) -> Iterator[Result]:
+        """Get each result, in the format the API returns."""
+        return (self[row] for row in range(len(self)))
+
+    def flagged_for(self, *categories: str) -> np.ndarray:
+        """
+        Check which texts are flagged in any of the categories given.
+
+        With no categories, this checks for any category flagged, like
+        ``any_flagged``. Returns a bool vector with an element for each text.
+        """
+        if not categories:
+            return self.flags.any(axis=1)
+        return self.flags[:, [_COLUMNS[name] for name in categories]].any(1)
+
+    def exceeding(self, thresholds: Mapping[str, float]) -> np.ndarray:
+        """
+        Check which texts score at least a category's threshold in any of them.
+
+        Categories not in thresholds are ignored. Returns a bool vector with an
+        element for each text.
+        """
+        bounds = np.full(len(CATEGORIES), np.inf, np.float32)
+        for category, threshold in thresholds.items():
+            bounds[_COLUMNS[category]] = threshold
+        return (self.scores >= bounds).any(axis=1)
+
+    def names_where(self, mask: np.ndarray) -> list[str]:
+        """Get the texts in the rows where a bool vector is true."""
+        return [self.names[row] for row in np.flatnonzero(mask).tolist()]
+
+    def align(self, names: Sequence[str]) -> 'Table':
+        """
+        Get the results for names, in their order, such as a search index's.
+
+        Masks computed from the new table then select the corresponding rows
+        of the other structure, such as an embeddings matrix. If the names are
+        already in this order, this table is returned as is.
+        """
+        if names == self.names:
+            return self
+        rows = {name: row for row, name in enumerate(self.names)}
+        positions = np.fromiter((rows[name] for name in names),
+                                dtype=np.intp, count=len(names))
+        return Table(names=list(names),
+                     flags=self.flags[positions],
+                     scores=self.scores[positions],
+                     flagged=self.flagged[positions])
+
+
+def _to_rows(results: Sequence[Result]) -> np.ndarray:
+    """
+    Convert moderation results from the API's format to cached rows.
+
+    Rows only have columns for CATEGORIES. Other categories in the results are
+    dropped, with a warning naming them.
+    """
+    rows = np.empty((len(results), _ROW_WIDTH), np.float32)
+    count = len(CATEGORIES)
+    unknown: set[str] = set()
+
+    for row, result in zip(rows, results):
+        scores = result['category_scores']
+        flags = result['categories']
+        row[:count] = [scores.get(name, math.nan) for name in CATEGORIES]
+        row[count:2 * count] = [flags.get(name, False) for name in CATEGORIES]
+        row[2 * count] = result['flagged']
+        unknown.update(scores.keys() - _COLUMNS, flags.keys() - _COLUMNS)
+
+    if unknown:
+        logging.warning('Dropping unknown moderation categories: %s.',
+                        ', '.join(sorted(unknown)))
+    return rows
+
+
+class _Store(_task.ArrayStore):
+    """
+    The cache of moderation results, as rows of scores and flags.
+
+    Results are added as rows, except that results imported from older caches
+    are in the API's format, and are converted first.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, task_name: str) -> None:
+        """Load the index and map the rows of the task with the given name."""
+        super().__init__(task_name, model=_MODEL, dim=_ROW_WIDTH)
+
+    def add(self, keys: list[str], texts: list[str], results: Any) -> None:
+        """Save rows, or results in the API's format, for distinct texts."""
+        if not isinstance(results, np.ndarray):
+            results = _to_rows(results)
+        super().add(keys, texts, results)
+
+
+def _moderate_chunk(texts: list[str]) -> list[Result]:
+    """Query the API for moderation results for one chunk of texts."""
+    # pylint: disable-next=import-outside-toplevel
+    import openai
+    return cast(Any, openai.Moderation.create(input=texts)).results
+
+
+def _plan_chunks(texts: list[str]) -> list[list[str]]:
+    """
+    Split texts into chunks, sized by how many texts there are in total.
+
+    Chunks are small enough to spread a list across all concurrent requests,
+    but have between _MIN_CHUNK_SIZE and _MAX_CHUNK_SIZE texts (unless there
+    are fewer texts than that), and at most _MAX_CHUNK_LENGTH total characters.
+    """
+    spread = math.ceil(len(texts) / MAX_CONCURRENT_REQUESTS)
+    ranges = _task.plan_batches(
+        [len(text) for text in texts],
+        max_count=min(max(spread, _MIN_CHUNK_SIZE), _MAX_CHUNK_SIZE),
+        max_weight=_MAX_CHUNK_LENGTH,
+    )
+    return [texts[chunk.start:chunk.stop] for chunk in ranges]
+
+
+@_task.api_task(_TASK_NAME, store=_Store, checkpoint=_CHECKPOINT_SIZE,
+                supersedes=_task.RecordStore, count_tokens=tokens.count)
+def _get_rows(texts: list[str]) -> np.ndarray:
+    """Load or query the API for cached rows of moderation results."""
+    chunks = _task.map_concurrently(
+        _moderate_chunk,
+        _plan_chunks(texts),
+        max_workers=MAX_CONCURRENT_REQUESTS,
+    )
+    return _to_rows([result for chunk in chunks for result in chunk])
+
+
+def get_moderation(texts: list[str]) -> Table:
+    """
+    Load or query the API for a table of moderation results for all texts.
+
+    Texts not yet cached are sent in chunks, with up to MAX_CONCURRENT_REQUESTS
+    requests in flight. A chunk that fails with a transient error is retried
+    by itself, without resending the others. Results keep the order of texts.
+    They are saved after every _CHECKPOINT_SIZE texts.
+
+    Results are cached as float32 rows in a memory-mapped file, so loading
+    them doesn't unpack a dict for each text. Results cached by earlier
+    versions, as dicts, are converted the first time their texts are used.
+    """
+    return Table.from_rows(texts, _get_rows(texts))
@@ -0,0 +1,210 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Finding pairs of similar names among all names, in bounded memory.
+
+Scoring every embedding against every other as one matrix product would take
+memory quadratic in the number of names. Instead, rows are taken in blocks, and
+each block is scored against the rows a tile at a time, remembering only the
+pairs kept: those scoring at least a threshold, each row's k best neighbors, or
+each row's k best neighbors among those at least the threshold. Blocks are
+scored in a thread pool, since NumPy releases the GIL for matrix products.
+
+The pairs found are edges of a graph, whose connected components are clusters
+of near-duplicate names.
+"""
+
+from __future__ import annotations
+
+__all__ = ['BLOCK_ROWS', 'TILE_ROWS', 'Edges', 'similar_pairs', 'clusters']
+
+import concurrent.futures
+import os
+from typing import Optional, TextIO
+
+import attrs
+import numpy as np
+
+from fr2ex.search import normalize
+
+BLOCK_ROWS = 1024
+"""Number of rows each task scores against all others."""
+
+TILE_ROWS = 8192
+"""Number of rows a block is scored against at a time, bounding memory use."""
+
+
+@attrs.frozen(eq=False)
+class Edges:
+    """Pairs of rows and their cosine similarities, as parallel arrays."""
+
+    sources: np.ndarray
+    """Row indices of the first row of each pair."""
+
+    targets: np.ndarray
+    """Row indices of the second row of each pair."""
+
+    scores: np.ndarray
+    """Cosine similarities of the pairs."""
+
+    def __len__(self) -> int:
+        """The number of pairs."""
+        return len(self.scores)
+
+    def write(self, file: TextIO, names: list[str]) -> None:
+        """Write the pairs as tab-separated names and scores, one per line."""
+        file.writelines(
+            f'{names[source]}\t{names[target]}\t{score:.6f}\n'
+            for source, target, score in zip(self.sources.tolist(),
+                                             self.targets.tolist(),
+                                             self.scores.tolist())
+        )
+
+
+def _mask_diagonal(scores: np.ndarray, row_start: int, column_start: int, *,
+                   upper: bool) -> None:
+    """Exclude pairs of a row with itself, and, if upper, with earlier rows."""
+    rows = np.arange(row_start, row_start + scores.shape[0])[:, np.newaxis]
+    columns = np.arange(column_start, column_start + scores.shape[1])
+    excluded = columns <= rows if upper else columns == rows
+    scores[excluded] = -np.inf
+
+
+def _keep_best(best_columns: np.ndarray, best_scores: np.ndarray,
+               columns: np.ndarray, scores: np.ndarray,
+               k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Merge a tile's scores into the best k so far in each row of a block."""
+    all_columns = np.concatenate(
+        (best_columns, np.broadcast_to(columns, scores.shape)), axis=1,
+    )
+    all_scores = np.concatenate((best_scores, scores), axis=1)
+    if all_scores.shape[1] <= k:
+        return all_columns, all_scores
+    chosen = np.argpartition(all_scores, -k, axis=1)[:, -k:]
+    return (np.take_along_axis(all_columns, chosen, axis=1),
+            np.take_along_axis(all_scores, chosen, axis=1))
+
+
+def _ranked(best_columns: np.ndarray, best_scores: np.ndarray,
+            start: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Order each row's best pairs by score, leaving out excluded pairs."""
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    best_columns = np.take_along_axis(best_columns, order, axis=1)
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+    rows, positions = np.nonzero(np.isfinite(best_scores))
+    return (rows + start, best_columns[rows, positions],
+            best_scores[rows, positions])
+
+
+def _score_block(matrix: np.ndarray, start: int, threshold: Optional[float],
+                 k: Optional[int]) -> tuple[np.ndarray, ...]:
+    """Find the pairs to keep whose first row is in a block of rows."""
+    block = matrix[start:start + BLOCK_ROWS]
+    stop = start + len(block)
+
+    # With no k, each pair is found once, from its earlier row.
+    first_column = start if k is None else 0
+    best_columns = np.empty((len(block), 0), np.intp)
+    best_scores = np.empty((len(block), 0), np.float32)
+    found: list[tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+    for column_start in range(first_column, len(matrix), TILE_ROWS):
+        tile = matrix[column_start:column_start + TILE_ROWS]
+        scores = block @ tile.T
+        if column_start < stop and column_start + len(tile) > start:
+            _mask_diagonal(scores, start, column_start, upper=k is None)
+
+        if k is None:
+            rows, columns = np.nonzero(scores >= threshold)
+            found.append((rows + start, columns + column_start,
+                          scores[rows, columns]))
+            continue
+
+        if threshold is not None:
+            scores[scores < threshold] = -np.inf
+        columns = np.arange(column_start, column_start + len(tile))
+        best_columns, best_scores = _keep_best(best_columns, best_scores,
+                                               columns, scores, k)
+
+    if k is not None:
+        found.append(_ranked(best_columns, best_scores, start))
+
+    if not found:
+        return (np.empty(0, np.intp), np.empty(0, np.intp),
+                np.empty(0, np.float32))
+    return tuple(np.concatenate(parts) for parts in zip(*found))
+
+
+def similar_pairs(embeddings: np.ndarray, *,
+                  threshold: Optional[float] = None, k: Optional[int] = None,
+                  max_workers: Optional[int] = None) -> Edges:
+    """
+    Find pairs of similar rows, without scoring all pairs at once.
+
+    With only a threshold, each pair scoring at least that is found once, with
+    the earlier row first. With k, each row's k best neighbors are found,
+    optionally only among those scoring at least the threshold, so a pair can
+    appear in both directions. Pairs are ordered by first row. Memory use is
+    bounded by about BLOCK_ROWS * TILE_ROWS scores per worker, plus the pairs.
+    """
+    if threshold is None and k is None:
+        raise ValueError('need a threshold, k, or both')
+    if k is not None and k <= 0:
+        raise ValueError(f'k must be positive, got {k}')
+
+    matrix = normalize(embeddings)
+    starts = range(0, len(matrix), BLOCK_ROWS)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+    ) as executor:
+        blocks = list(executor.map(
+            lambda start: _score_block(matrix, start, threshold, k),
+            starts,
+        ))
+
+    if not blocks:
+        return Edges(np.empty(0, np.intp), np.empty(0, np.intp),
+                     np.empty(0, np.float32))
+    sources, targets, scores = (np.concatenate(parts)
+                                for parts in zip(*blocks))
+    return Edges(sources, targets, scores)
+
+
+def clusters(edges: Edges, count: int) -> np.ndarray:
+    """
+    Label each of count rows with the connected component edges put it in.
+
+    Components are numbered in order of their first rows, so rows with no
+    edges are each in their own cluster.
+    """
+    parents = list(range(count))
+
+    def find(row: int) -> int:
+        while parents[row] != row:
+            parents[row] = parents[parents[row]]
+            row = parents[row]
+        return row
+
+    for source, target in zip(edges.sources.tolist(), edges.targets.tolist()):
+        source_root = find(source)
+        target_root = find(target)
+        if source_root != target_root:
+            parents[max(source_root, target_root)] = min(source_root,
+                                                         target_root)
+
+    roots = np.fromiter((find(row) for row in range(count)),
+                        dtype=np.intp, count=count)
+    _, labels = np.unique(roots, return_inverse=True)
+    return labels
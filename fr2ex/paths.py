@@ -13,9 +13,16 @@
 
 """Paths used in modules and notebooks."""
 
-__all__ = ['default_api_key_file', 'data_dir']
+__all__ = [
+    'default_api_key_file',
+    'data_dir',
+    'cache_limit',
+]
 
+import logging
+import os
 from pathlib import Path
+from typing import Optional
 
 _fixed_parent_path = Path(__file__).absolute().parent.parent
 """The parent directory of the directory that contains this module."""
@@ -23,5 +30,36 @@ _fixed_parent_path = Path(__file__).absolute().parent.parent
 default_api_key_file = _fixed_parent_path / '.api_key'
 """The default path for a file that contains the OpenAI API key."""
 
-data_dir = _fixed_parent_path / 'data'
-"""The directory where we keep the saved data files (the cache)."""
+data_dir = Path(
+    os.environ.get('FR2EX_DATA_DIR') or _fixed_parent_path / 'data',
+)
+"""The directory where we keep the saved data files (the cache).
+
+The FR2EX_DATA_DIR environment variable, if set, names a different directory.
+"""
+
+
+def _read_cache_limit() -> Optional[int]:
+    """Read FR2EX_CACHE_LIMIT, warning about and ignoring an unusable value."""
+    value = os.environ.get('FR2EX_CACHE_LIMIT')
+    if not value:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        logging.warning('Ignoring FR2EX_CACHE_LIMIT=%r, which is not a '
+                        'number of bytes. The cache has no limit.', value)
+        return None
+    return limit
+
+
+cache_limit = _read_cache_limit()
+"""The most bytes the data directory should hold, or None for no limit.
+
+When an API task saves new results and the data directory is bigger than this,
+the least recently used cached results are evicted. The FR2EX_CACHE_LIMIT
+environment variable, if set, gives the limit. If it isn't a whole number of
+bytes, a warning is logged and there is no limit.
+"""
@@ -0,0 +1,179 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Fetching, moderating, and embedding repository names, resumably.
+
+The names are split into chunks of CHUNK_SIZE. Moderation and embedding each
+run in their own thread, working through the chunks in order. Each moderated
+chunk is handed to embedding, which embeds only the names that weren't
+flagged. So moderating one chunk overlaps embedding the one before, instead of
+all moderation finishing before any embedding starts, and flagged names are
+never sent to the embeddings endpoint. Each stage's results are cached per text
+as it goes, so if a run is interrupted, running again skips everything already
+done and redoes at most the chunks that were in progress.
+"""
+
+from __future__ import annotations
+
+__all__ = ['CHUNK_SIZE', 'Progress', 'Result', 'run']
+
+import concurrent.futures
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, Optional
+
+import attrs
+
+from fr2ex import embedding, moderation, remote
+from fr2ex.search import Index
+
+CHUNK_SIZE = 4096
+"""Number of names each stage processes, and saves, at a time."""
+
+Progress = Callable[[str, int, int], None]
+"""Callback given a stage name, names done so far, and all names to do."""
+
+
+@attrs.frozen
+class Result:
+    """What a pipeline run produced."""
+
+    names: list[str]
+    """All repository names, in the order they were processed."""
+
+    flagged: list[str]
+    """Names whose moderation results flag any category."""
+
+    index: Index
+    """A search index over the names that weren't flagged."""
+
+
+class _Stopped(Exception):
+    """A stage stopped early because another stage failed."""
+
+
+def _log_progress(stage: str, done: int, total: int) -> None:
+    """Log a stage's progress. This is the default progress callback."""
+    logging.info('Pipeline %s stage: %d of %d names done.', stage, done, total)
+
+
+@attrs.frozen
+class _Run:
+    """The state shared by the stages of one run, and the stages themselves."""
+
+    total: int
+    """Number of names to process."""
+
+    progress: Progress
+    """Callback to report each stage's progress to."""
+
+    stop: threading.Event = attrs.field(factory=threading.Event)
+    """Set when the stages should stop, because one of them failed."""
+
+    flagged: set[str] = attrs.field(factory=set)
+    """Names moderation has flagged so far."""
+
+    moderated: queue.SimpleQueue[Optional[list[str]]] = attrs.field(
+        factory=queue.SimpleQueue,
+    )
+    """Chunks moderation has finished, then None once it stops."""
+
+    def moderate_all(self, chunks: list[list[str]]) -> list[list[str]]:
+        """Moderate and hand on each chunk. Return each one's flagged names."""
+        try:
+            return self._stage('moderation', self._moderate, chunks)
+        finally:
+            self.moderated.put(None)
+
+    def embed_all(self) -> None:
+        """Embed the names moderation didn't flag, in each chunk handed on."""
+        self._stage('embedding', self._embed, iter(self.moderated.get, None))
+
+    def _moderate(self, chunk: list[str]) -> list[str]:
+        """Moderate a chunk, hand it on, and return its flagged names."""
+        table = moderation.get_moderation(chunk)
+        flagged = table.names_where(table.flagged_for())
+        self.flagged.update(flagged)
+        self.moderated.put(chunk)
+        return flagged
+
+    def _embed(self, chunk: list[str]) -> None:
+        """Embed the names in a moderated chunk that weren't flagged."""
+        embedding.embed_many([name for name in chunk
+                              if name not in self.flagged])
+
+    def _stage(self, stage: str, func: Callable[[list[str]], Any],
+               chunks: Iterable[list[str]]) -> list[Any]:
+        """Run one stage's function on each chunk, unless told to stop."""
+        results = []
+        done = 0
+
+        for chunk in chunks:
+            if self.stop.is_set():
+                raise _Stopped(stage)
+            try:
+                results.append(func(chunk))
+            except BaseException:
+                self.stop.set()
+                raise
+            done += len(chunk)
+            self.progress(stage, done, self.total)
+
+        return results
+
+
+def run(names: Optional[list[str]] = None, *,
+        chunk_size: int = CHUNK_SIZE,
+        progress: Progress = _log_progress) -> Result:
+    """
+    Moderate repository names, and embed and index those not flagged.
+
+    If names are not given, they are synced from the remote Git server. If a
+    stage fails, the other stops after its current chunk, and the error is
+    raised. The same happens on KeyboardInterrupt. Either way, every chunk that
+    finished is saved, and will not be sent to the API again.
+    """
+    if names is None:
+        names = remote.sync_repo_names().names
+
+    chunks = [names[start:start + chunk_size]
+              for start in range(0, len(names), chunk_size)]
+    shared = _Run(len(names), progress)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        moderating = executor.submit(shared.moderate_all, chunks)
+        stages: list[concurrent.futures.Future[Any]] = [
+            moderating, executor.submit(shared.embed_all),
+        ]
+        try:
+            concurrent.futures.wait(
+                stages, return_when=concurrent.futures.FIRST_EXCEPTION,
+            )
+        except BaseException:
+            shared.stop.set()
+            raise
+
+        shared.stop.set()  # If one stage failed, stop the other.
+        for future in stages:
+            error = future.exception()
+            if error is not None and not isinstance(error, _Stopped):
+                raise error
+
+    # Everything is cached now, so this just reads it, in the order of names.
+    kept = [name for name in names if name not in shared.flagged]
+    return Result(names=names,
+                  flagged=[name for flagged in moderating.result()
+                           for name in flagged],
+                  index=Index(kept, embedding.embed_many(kept)))
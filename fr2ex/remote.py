@@ -13,12 +13,50 @@
 
 """Accessing repository information on the remote server."""
 
-__all__ = ['fetch_repo_names']
+from __future__ import annotations
 
+__all__ = [
+    'REPO_DIR',
+    'GIT_SUFFIX',
+    'MAX_CHANNELS',
+    'METADATA_FILES',
+    'Client',
+    'LocalClient',
+    'Changes',
+    'RepoMetadata',
+    'fetch_repo_names',
+    'sync_repo_names',
+    'fetch_metadata',
+    'close_connections',
+]
+
+import atexit
+import concurrent.futures
+import contextlib
+import os
 import pathlib
+import threading
+import time
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    ContextManager,
+    Iterable,
+    Iterator,
+    Optional,
+    Protocol,
+)
+
+import attrs
+import msgpack
 
-import fabric
+from fr2ex import _task, paths
 
+if TYPE_CHECKING:
+    import fabric
+    import paramiko
 
 REPO_DIR = '/repos'
 """Absolute path to the directory on the server where repos are kept."""
@@ -26,18 +64,403 @@ REPO_DIR = '/repos'
 GIT_SUFFIX = '.git'
 """The extension to expect, strip from, and restore to repo pathnames."""
 
+MAX_CHANNELS = 8
+"""
+Most SFTP channels to open at once on the connection to a host.
 
-def fetch_repo_names() -> list[str]:
-    """Obtain a list of repository names from the remote Git server."""
-    # Find out the hostname of the server that has the remote repositories.
+OpenSSH allows 10 sessions per connection by default, so this leaves room.
+"""
+
+METADATA_FILES = ('description', 'HEAD')
+"""Files in each repository that fetch_metadata fetches by default."""
+
+_STATE_FORMAT = 1
+"""Version of the format sync_repo_names saves listings in."""
+
+_METADATA_FORMAT = 1
+"""Version of the format fetch_metadata caches files in."""
+
+_MAX_FILE_SIZE = 64 * 1024
+"""Most bytes fetch_metadata reads from the start of each file."""
+
+_DEFAULT_DESCRIPTION = (
+    "Unnamed repository; edit this file 'description' to name the repository."
+)
+"""The description Git puts in new repositories, meaning there is none."""
+
+_HEAD_PREFIX = 'ref: refs/heads/'
+"""What a HEAD file that names a branch starts with."""
+
+_RACY_SECONDS = 2
+"""How close a listing can be to a directory's mtime for us to distrust it."""
+
+
+class Client(Protocol):
+    """Protocol for the parts of paramiko.SFTPClient used to list repos."""
+
+    def stat(self, path: str) -> paramiko.SFTPAttributes:
+        """Get the status of a file, following symlinks."""
+
+    def listdir_attr(self, path: str = '.') -> list[paramiko.SFTPAttributes]:
+        """List the status of each entry in a directory."""
+
+    def open(self, filename: str, mode: str = 'r') -> IO[bytes]:
+        """Open a file. Reading it gives bytes, whatever the mode."""
+
+
+class LocalClient:
+    """A Client for the local filesystem, to stand in for an SFTP server."""
+
+    def stat(self, path: str) -> paramiko.SFTPAttributes:
+        """Get the status of a file, following symlinks."""
+        # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+        import paramiko
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    def listdir_attr(self, path: str = '.') -> list[paramiko.SFTPAttributes]:
+        """List the status of each entry in a directory."""
+        # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+        import paramiko
+        with os.scandir(path) as entries:
+            return [paramiko.SFTPAttributes.from_stat(entry.stat(), entry.name)
+                    for entry in entries]
+
+    def open(self, filename: str, mode: str = 'r') -> IO[bytes]:
+        """Open a file. Reading it gives bytes, whatever the mode."""
+        return open(filename, mode.replace('b', '') + 'b')
+
+
+@attrs.frozen
+class Changes:
+    """The current repository names, and how they differ from the last sync."""
+
+    names: list[str]
+    """All repository names, sorted."""
+
+    added: list[str]
+    """Names that were not present at the last sync, sorted."""
+
+    removed: list[str]
+    """Names that were present at the last sync but are now gone, sorted."""
+
+    @property
+    def changed(self) -> bool:
+        """Whether any names were added or removed."""
+        return bool(self.added or self.removed)
+
+
+@attrs.frozen
+class RepoMetadata:
+    """Metadata files fetched from a repository, and what they tell us."""
+
+    name: str
+    """The repository name."""
+
+    files: dict[str, bytes]
+    """Contents of each requested file the repository has, up to 64 KiB."""
+
+    @property
+    def description(self) -> Optional[str]:
+        """The repository's description, unless it is missing or Git's."""
+        try:
+            text = self.files['description'].decode(errors='replace').strip()
+        except KeyError:
+            return None
+        return None if not text or text == _DEFAULT_DESCRIPTION else text
+
+    @property
+    def default_branch(self) -> Optional[str]:
+        """The branch HEAD refers to, unless HEAD is missing or detached."""
+        try:
+            text = self.files['HEAD'].decode(errors='replace').strip()
+        except KeyError:
+            return None
+        if not text.startswith(_HEAD_PREFIX):
+            return None
+        return text.removeprefix(_HEAD_PREFIX)
+
+
+class _HostPool:
+    """An SSH connection to one host, and the SFTP channels opened on it."""
+
+    __slots__ = ('_hostname', '_lock', '_slots', '_connection', '_idle')
+
+    def __init__(self, hostname: str) -> None:
+        """Create a pool for a host. Nothing is opened until it is needed."""
+        self._hostname = hostname
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(MAX_CHANNELS)
+        self._connection: Optional[fabric.Connection] = None
+        self._idle: list[paramiko.SFTPClient] = []
+
+    @contextlib.contextmanager
+    def sftp(self) -> Iterator[paramiko.SFTPClient]:
+        """Borrow an SFTP channel, waiting if MAX_CHANNELS are in use."""
+        with self._slots:
+            with self._lock:
+                channel = self._idle.pop() if self._idle else self._open()
+            try:
+                yield channel
+            except BaseException:
+                channel.close()  # It may be in a bad state. Don't reuse it.
+                raise
+            with self._lock:
+                self._idle.append(channel)
+
+    def close(self) -> None:
+        """Close all channels and the connection."""
+        with self._lock:
+            for channel in self._idle:
+                channel.close()
+            self._idle.clear()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _open(self) -> paramiko.SFTPClient:
+        """Open a channel, first (re)connecting if needed. Hold the lock."""
+        # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+        import fabric
+        # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+        import paramiko
+
+        if self._connection is None or not self._connection.is_connected:
+            self._idle.clear()
+            self._connection = fabric.Connection(self._hostname)
+            self._connection.open()
+
+        return paramiko.SFTPClient.from_transport(self._connection.transport)
+
+
+_pools: dict[str, _HostPool] = {}
+"""Connection pools, by hostname."""
+
+_pools_lock = threading.Lock()
+"""Mutex for creating connection pools."""
+
+
+def _get_pool(hostname: str) -> _HostPool:
+    """Get the connection pool for a host, creating it if needed."""
+    with _pools_lock:
+        try:
+            return _pools[hostname]
+        except KeyError:
+            pool = _pools[hostname] = _HostPool(hostname)
+            return pool
+
+
+@atexit.register
+def close_connections() -> None:
+    """Close all pooled connections. They reopen as needed."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+
+def _read_hostname() -> str:
+    """Find out the hostname of the server that has the remote repositories."""
     config_path = pathlib.Path.home() / '.nrr-frr-server'
     with open(config_path, encoding='utf-8') as file:
-        hostname = file.read().strip()
+        return file.read().strip()
 
-    # List the contents of the "public" repositories directory on that server.
-    with fabric.Connection(hostname) as connection:
-        entries = connection.sftp().listdir(REPO_DIR)
 
-    # Return names that end in the appropriate suffix, stripping the suffix.
+def _repo_names(entries: Iterable[str]) -> list[str]:
+    """Get names that end in the appropriate suffix, stripping the suffix."""
     return sorted(entry.removesuffix(GIT_SUFFIX) for entry in entries
                   if entry.endswith(GIT_SUFFIX))
+
+
+def fetch_repo_names() -> list[str]:
+    """Obtain a list of repository names from the remote Git server."""
+    # List the contents of the "public" repositories directory on that server.
+    with _get_pool(_read_hostname()).sftp() as sftp:
+        entries = sftp.listdir(REPO_DIR)
+
+    return _repo_names(entries)
+
+
+def _load_state(path: pathlib.Path) -> Optional[dict[str, Any]]:
+    """Load the listing saved by the last sync, if there is a usable one."""
+    try:
+        with open(path, 'rb') as file:
+            state = msgpack.unpack(file, raw=False)
+    except FileNotFoundError:
+        return None
+    return state if state.get('format') == _STATE_FORMAT else None
+
+
+def _save_state(path: pathlib.Path, state: dict[str, Any]) -> None:
+    """Save state atomically, so an interrupted sync can't corrupt it."""
+    _task.replace_atomically(path, lambda file: msgpack.pack(state, file))
+
+
+def _default_state_path(hostname: str, repo_dir: str) -> pathlib.Path:
+    """Build the path where the listing for a server directory is saved."""
+    key = _task.build_key(f'{hostname}:{repo_dir}')
+    return paths.data_dir / f'repos-{key}.msgpack'
+
+
+def _sync(client: Client, repo_dir: str, state_path: pathlib.Path) -> Changes:
+    """Sync the listing of repo_dir through client. Helper for sync."""
+    old_state = _load_state(state_path)
+    old_names = [] if old_state is None else old_state['names']
+    mtime = client.stat(repo_dir).st_mtime
+
+    if (old_state is not None and old_state['mtime'] == mtime
+            and old_state['listed_at'] - mtime > _RACY_SECONDS):
+        return Changes(names=old_names, added=[], removed=[])
+
+    listed_at = time.time()
+    entries = {attributes.filename: [attributes.st_mtime, attributes.st_size]
+               for attributes in client.listdir_attr(repo_dir)
+               if attributes.filename.endswith(GIT_SUFFIX)}
+    names = _repo_names(entries)
+
+    _save_state(state_path, {
+        'format': _STATE_FORMAT,
+        'mtime': mtime,
+        'listed_at': listed_at,
+        'names': names,
+        'entries': entries,
+    })
+
+    old_name_set = set(old_names)
+    name_set = set(names)
+    return Changes(
+        names=names,
+        added=[name for name in names if name not in old_name_set],
+        removed=[name for name in old_names if name not in name_set],
+    )
+
+
+def sync_repo_names(client: Optional[Client] = None, *,
+                    repo_dir: str = REPO_DIR,
+                    state_path: Optional[pathlib.Path] = None) -> Changes:
+    """
+    Obtain repository names, and the changes since the last sync.
+
+    The last listing is kept locally, with the directory's mtime and the stats
+    of each entry. If the directory's mtime hasn't changed since then, it is
+    not listed again. (The mtime is not trusted if it is within _RACY_SECONDS
+    of when the listing was made, since a change could have followed quickly.)
+
+    By default, this connects to the remote Git server. To list a directory
+    some other way, such as with LocalClient, pass a client and a state_path.
+    """
+    if client is not None:
+        if state_path is None:
+            raise TypeError('state_path is required when a client is passed')
+        return _sync(client, repo_dir, state_path)
+
+    hostname = _read_hostname()
+    if state_path is None:
+        state_path = _default_state_path(hostname, repo_dir)
+
+    with _get_pool(hostname).sftp() as sftp:
+        return _sync(sftp, repo_dir, state_path)
+
+
+def _fetch_files(client: Client, repo_path: str, filenames: frozenset[str],
+                 cached: dict[str, list[Any]]) -> dict[str, list[Any]]:
+    """
+    Fetch the files of one repository that have changed since being cached.
+
+    Each file is cached as ``[mtime, size, content]``. If the file was modified
+    within _RACY_SECONDS, its mtime is cached as None, so it is fetched again.
+    """
+    try:
+        entries = [attributes for attributes in client.listdir_attr(repo_path)
+                   if attributes.filename in filenames]
+    except FileNotFoundError:
+        return {}
+
+    now = time.time()
+    files = {}
+
+    for attributes in entries:
+        mtime = attributes.st_mtime
+        if mtime is not None and now - mtime <= _RACY_SECONDS:
+            mtime = None
+        stamp = [mtime, attributes.st_size]
+
+        old = cached.get(attributes.filename)
+        if mtime is not None and old is not None and old[:2] == stamp:
+            files[attributes.filename] = old
+            continue
+
+        path = f'{repo_path}/{attributes.filename}'
+        with contextlib.suppress(FileNotFoundError):
+            with client.open(path, 'rb') as file:
+                content = file.read(_MAX_FILE_SIZE)
+            files[attributes.filename] = [*stamp, content]
+
+    return files
+
+
+def _load_metadata_cache(path: pathlib.Path) -> dict[str, Any]:
+    """Load the files cached by the last fetch_metadata, if usable."""
+    try:
+        with open(path, 'rb') as file:
+            cache = msgpack.unpack(file, raw=False)
+    except FileNotFoundError:
+        return {}
+    return cache['repos'] if cache.get('format') == _METADATA_FORMAT else {}
+
+
+def _default_metadata_path(hostname: str, repo_dir: str) -> pathlib.Path:
+    """Build the path where metadata for a server directory is cached."""
+    key = _task.build_key(f'{hostname}:{repo_dir}')
+    return paths.data_dir / f'repo-metadata-{key}.msgpack'
+
+
+def fetch_metadata(
+    names: list[str], *, files: Iterable[str] = METADATA_FILES,
+    client: Optional[Client] = None, repo_dir: str = REPO_DIR,
+    cache_path: Optional[pathlib.Path] = None,
+) -> list[RepoMetadata]:
+    """
+    Fetch metadata files from each named repository, concurrently.
+
+    Repositories are fetched by up to MAX_CHANNELS threads. By default, each
+    thread borrows one of the SFTP channels pooled on a single connection to
+    the remote Git server. Each repository's directory is listed, and only
+    files whose mtime or size changed since they were cached are read, so
+    fetching again is one round trip per repository.
+
+    To fetch some other way, such as with LocalClient, pass a thread-safe
+    client and a cache_path.
+    """
+    if client is not None:
+        if cache_path is None:
+            raise TypeError('cache_path is required when a client is passed')
+        borrow: Callable[[], ContextManager[Client]] = (
+            lambda: contextlib.nullcontext(client)
+        )
+    else:
+        hostname = _read_hostname()
+        if cache_path is None:
+            cache_path = _default_metadata_path(hostname, repo_dir)
+        borrow = _get_pool(hostname).sftp
+
+    filenames = frozenset(files)
+    cache = _load_metadata_cache(cache_path)
+
+    def fetch(name: str) -> dict[str, list[Any]]:
+        with borrow() as borrowed:
+            return _fetch_files(borrowed, f'{repo_dir}/{name}{GIT_SUFFIX}',
+                                filenames, cache.get(name, {}))
+
+    with concurrent.futures.ThreadPoolExecutor(MAX_CHANNELS) as executor:
+        fetched = dict(zip(names, executor.map(fetch, names)))
+
+    _save_state(cache_path, {
+        'format': _METADATA_FORMAT,
+        'repos': {**cache, **fetched},
+    })
+
+    return [
+        RepoMetadata(name, {filename: entry[2]
+                            for filename, entry in entries.items()})
+        for name, entries in fetched.items()
+    ]
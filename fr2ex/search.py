@@ -0,0 +1,150 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Searching embedded repository names by cosine similarity.
+
+An Index holds the embeddings of all names as one contiguous matrix of unit
+vectors, so scoring a query is a single matrix-vector product. The best scores
+are then selected with a partial sort, and only those are fully sorted.
+"""
+
+from __future__ import annotations
+
+__all__ = ['Match', 'Index', 'normalize', 'top_k']
+
+from typing import Optional
+
+import attrs
+import numpy as np
+
+from fr2ex import embedding
+
+_NORM_TOLERANCE = 1e-3
+"""How far from 1 row norms can be for rows to be used without normalizing."""
+
+
+@attrs.frozen
+class Match:
+    """A name found by a search, and how similar it is to the query."""
+
+    name: str
+    """The repository name."""
+
+    score: float
+    """The cosine similarity of the name's embedding to the query's."""
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    """
+    Get a C-contiguous float32 matrix with the rows of matrix scaled to norm 1.
+
+    If the rows already have unit norm (as text-embedding-ada-002 embeddings
+    do), and the matrix is already C-contiguous float32, it is not copied. This
+    keeps a memory-mapped matrix from embed_many mapped. Zero rows stay zero.
+    """
+    matrix = np.ascontiguousarray(matrix, np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    if np.all(np.abs(norms - 1) <= _NORM_TOLERANCE):
+        return matrix
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k(scores: np.ndarray, k: int,
+          threshold: Optional[float] = None) -> np.ndarray:
+    """
+    Find the indices of the k highest scores, from highest to lowest.
+
+    Scores below threshold, if it is given, are excluded. This takes linear
+    time in the number of scores, plus O(k log k) to sort the ones selected.
+    """
+    if k <= 0:
+        return np.empty(0, np.intp)
+
+    if threshold is None:
+        candidates = None
+        pool = scores
+    else:
+        candidates = np.flatnonzero(scores >= threshold)
+        pool = scores[candidates]
+
+    if k < len(pool):
+        best = np.argpartition(pool, len(pool) - k)[len(pool) - k:]
+    else:
+        best = np.arange(len(pool))
+
+    best = best[np.argsort(-pool[best], kind='stable')]
+    return best if candidates is None else candidates[best]
+
+
+class Index:
+    """Exact cosine-similarity search over names and their embeddings."""
+
+    __slots__ = ('_names', '_matrix')
+
+    def __init__(self, names: list[str],
+                 embeddings: embedding.EmbeddingsMatrix) -> None:
+        """Build an index from names and embeddings in corresponding order."""
+        if len(names) != len(embeddings):
+            raise ValueError(f'got {len(names)} names but '
+                             f'{len(embeddings)} embeddings')
+        self._names = list(names)
+        self._matrix = normalize(embeddings)
+
+    @classmethod
+    def from_names(cls, names: list[str]) -> 'Index':
+        """Build an index from names, loading or querying their embeddings."""
+        return cls(names, embedding.embed_many(names))
+
+    def __len__(self) -> int:
+        """The number of names in the index."""
+        return len(self._names)
+
+    @property
+    def names(self) -> list[str]:
+        """The names in the index, in the order of the matrix rows."""
+        return self._names
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """The matrix of unit-normalized embeddings, one row per name."""
+        return self._matrix
+
+    def select(self, rows: np.ndarray) -> 'Index':
+        """
+        Build an index of some of the names, given as row indices or a mask.
+
+        A bool mask, such as one from ``moderation.Table`` aligned with this
+        index's names, keeps the rows where it is true.
+        """
+        if rows.dtype == np.bool_:
+            rows = np.flatnonzero(rows)
+        return Index([self._names[row] for row in rows.tolist()],
+                     self._matrix[rows])
+
+    def scores(self, vector: embedding.EmbeddingVector) -> np.ndarray:
+        """Compute the cosine similarity of every name to an embedding."""
+        return self._matrix @ normalize(vector)
+
+    def search(self, vector: embedding.EmbeddingVector, k: int = 5, *,
+               threshold: Optional[float] = None) -> list[Match]:
+        """Find the k names most similar to an embedding, best first."""
+        scores = self.scores(vector)
+        return [Match(self._names[index], float(scores[index]))
+                for index in top_k(scores, k, threshold)]
+
+    def query(self, text: str, k: int = 5, *,
+              threshold: Optional[float] = None) -> list[Match]:
+        """Find the k names most similar to a text, best first."""
+        return self.search(embedding.embed(text), k, threshold=threshold)
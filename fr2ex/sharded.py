@@ -0,0 +1,235 @@
+# Copyright (c) 2023 Eliah Kagan
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Exact search with the matrix split into shards, each scored in its own process.
+
+The normalized embeddings are written once to a file in shared memory (or, if
+there is none, a temporary directory), which every worker process maps
+read-only, so the rows are never copied per worker. A batch of queries is
+scored against each shard as one matrix-matrix product, with a single-threaded
+BLAS in each worker so that the workers don't compete for cores. Each shard's
+best k are then combined by a k-way merge.
+
+This pays off for batches of many queries on many cores. For one query at a
+time, search.Index is simpler and about as fast.
+"""
+
+from __future__ import annotations
+
+__all__ = ['ShardedIndex']
+
+import concurrent.futures
+import contextlib
+import functools
+import heapq
+import itertools
+import multiprocessing
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from typing import Iterator, Optional
+import weakref
+
+import numpy as np
+
+from fr2ex import embedding
+from fr2ex.search import Match, normalize, top_k
+
+_SHARED_MEMORY_DIR = Path('/dev/shm')
+"""Where to put the shared matrix file, if this directory has room for it."""
+
+_BLAS_THREAD_VARIABLES = (
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+)
+"""Environment variables that limit BLAS threads, set to 1 for workers."""
+
+Candidates = list[tuple[float, int]]
+"""A query's best (score, row) pairs in one shard, from best to worst."""
+
+
+@functools.cache
+def _map_shared(path: str, shape: tuple[int, ...]) -> np.ndarray:
+    """In a worker process, map the shared matrix, or get it if mapped."""
+    return np.memmap(path, dtype=np.float32, mode='r', shape=shape)
+
+
+def _score_shard(shared: tuple[str, tuple[int, ...]], rows: slice,
+                 queries: np.ndarray, k: int,
+                 threshold: Optional[float]) -> list[Candidates]:
+    """In a worker process, find each query's best k rows in one shard."""
+    scores = queries @ _map_shared(*shared)[rows].T
+    return [
+        [(float(row_scores[index]), rows.start + int(index))
+         for index in top_k(row_scores, k, threshold)]
+        for row_scores in scores
+    ]
+
+
+@contextlib.contextmanager
+def _single_threaded_blas() -> Iterator[None]:
+    """Limit BLAS to one thread in processes started during a block."""
+    saved = {name: os.environ.get(name) for name in _BLAS_THREAD_VARIABLES}
+    os.environ.update(dict.fromkeys(_BLAS_THREAD_VARIABLES, '1'))
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def _shared_directory(size: int) -> Optional[Path]:
+    """Pick _SHARED_MEMORY_DIR if it has room for size bytes, else None."""
+    try:
+        free = shutil.disk_usage(_SHARED_MEMORY_DIR).free
+    except OSError:
+        return None
+    return _SHARED_MEMORY_DIR if free >= size else None
+
+
+def _write_shared(matrix: np.ndarray) -> Path:
+    """
+    Write the rows of a matrix to a new file that processes can map.
+
+    The file goes in _SHARED_MEMORY_DIR if there is room for it there, or in
+    the default temporary directory otherwise. If writing fails, the partial
+    file is deleted.
+    """
+    with tempfile.NamedTemporaryFile(prefix='fr2ex-shards-', suffix='.f32',
+                                     dir=_shared_directory(matrix.nbytes),
+                                     delete=False) as file:
+        try:
+            matrix.tofile(file)
+        except BaseException:
+            file.close()
+            os.unlink(file.name)
+            raise
+    return Path(file.name)
+
+
+def _release(executor: concurrent.futures.Executor, path: Path) -> None:
+    """Stop the workers and delete the shared matrix file."""
+    executor.shutdown()
+    path.unlink(missing_ok=True)
+
+
+class ShardedIndex:
+    """Exact cosine-similarity search, sharded across worker processes."""
+
+    __slots__ = ('_names', '_bounds', '_shared', '_executor', '_finalizer',
+                 '__weakref__')
+
+    def __init__(self, names: list[str],
+                 embeddings: embedding.EmbeddingsMatrix, *,
+                 workers: Optional[int] = None) -> None:
+        """
+        Build an index from names and embeddings in corresponding order.
+
+        This starts the worker processes, one per shard. By default there are
+        as many as there are CPUs. Call close, or use the index in a with
+        statement, to stop them.
+        """
+        if len(names) != len(embeddings):
+            raise ValueError(f'got {len(names)} names but '
+                             f'{len(embeddings)} embeddings')
+        if not names:
+            raise ValueError('no names to index')
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        matrix = np.ascontiguousarray(normalize(embeddings), np.float32)
+        shard_count = min(workers, len(matrix))
+        self._names = list(names)
+        self._bounds = np.linspace(0, len(matrix), shard_count + 1,
+                                   dtype=np.intp).tolist()
+        self._shared = (str(_write_shared(matrix)), matrix.shape)
+
+        # No worker processes are started until work is submitted, so the
+        # finalizer can take charge of the file before anything else fails.
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=shard_count,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_map_shared,
+            initargs=self._shared,
+        )
+        self._finalizer = weakref.finalize(self, _release, self._executor,
+                                           Path(self._shared[0]))
+
+        # Workers are started as work arrives and none is idle, so start them
+        # all now, while the environment limits their BLAS threads.
+        with _single_threaded_blas():
+            for future in [self._executor.submit(int)
+                           for _ in range(shard_count)]:
+                future.result()
+
+    def __enter__(self) -> ShardedIndex:
+        """Use the index for the duration of a block."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Stop the worker processes."""
+        self.close()
+
+    def __len__(self) -> int:
+        """The number of names in the index."""
+        return len(self._names)
+
+    @property
+    def names(self) -> list[str]:
+        """The names in the index, in the order of the matrix rows."""
+        return self._names
+
+    @property
+    def shard_count(self) -> int:
+        """The number of shards, each scored by its own worker process."""
+        return len(self._bounds) - 1
+
+    def close(self) -> None:
+        """Stop the worker processes and free the shared matrix."""
+        self._finalizer()
+
+    def search_many(self, vectors: np.ndarray, k: int = 5, *,
+                    threshold: Optional[float] = None) -> list[list[Match]]:
+        """Find the k names most similar to each row of vectors, best first."""
+        queries = normalize(np.atleast_2d(vectors))
+        futures = [
+            self._executor.submit(_score_shard, self._shared,
+                                  slice(start, stop), queries, k, threshold)
+            for start, stop in zip(self._bounds[:-1], self._bounds[1:])
+        ]
+        per_shard = [future.result() for future in futures]
+
+        return [
+            [Match(self._names[row], score)
+             for score, row in itertools.islice(
+                 heapq.merge(*candidates, key=lambda pair: -pair[0]), k,
+             )]
+            for candidates in zip(*per_shard)
+        ]
+
+    def search(self, vector: embedding.EmbeddingVector, k: int = 5, *,
+               threshold: Optional[float] = None) -> list[Match]:
+        """Find the k names most similar to an embedding, best first."""
+        return self.search_many(vector, k, threshold=threshold)[0]
+
+    def query(self, text: str, k: int = 5, *,
+              threshold: Optional[float] = None) -> list[Match]:
+        """Find the k names most similar to a text, best first."""
+        return self.search(embedding.embed(text), k, threshold=threshold)
@@ -15,33 +15,70 @@
 Counting and displaying cl100k_base tokens (used by text-embedding-ada-002).
 
 This also computes pricing estimates for the text-embedding-ada-002 models.
+
+Token counts are cached per text, in a file keyed like the API task caches, so
+estimating the cost of a mostly unchanged list only encodes the new texts.
 """
 
 __all__ = [
+    'COUNT_CHUNK_SIZE',
     'DEFAULT_BASE_STYLING',
+    'DEFAULT_HTML_BASE_STYLING',
+    'DEFAULT_HTML_STYLING_CYCLE',
     'DEFAULT_STYLING_CYCLE',
+    'PRICES_MAX_AGE',
     'PriceRetrievalError',
     'Rate',
     'count',
+    'count_each',
     'find_embedding_model_prices',
+    'iter_counts',
+    'render',
     'report_cost',
     'show',
 ]
 
+import codecs
+import concurrent.futures
 import datetime
 from decimal import Decimal
 import functools
-import io
+import html
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
 import re
+import sys
 import textwrap
-from typing import Iterable, Iterator, Optional, Sequence
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Literal,
+    Optional,
+    Sequence,
+    TextIO,
+)
 
 import attrs
-import bs4
 import colorama
-import pandas
-import requests
-import tiktoken
+import more_itertools
+
+from fr2ex import _task, paths
+
+if TYPE_CHECKING:
+    import bs4
+    import tiktoken
+
+COUNT_CHUNK_SIZE = 8192
+"""How many texts are encoded at a time when counting, at most."""
+
+PRICES_MAX_AGE = datetime.timedelta(days=1)
+"""How long retrieved prices are reused for before retrieving them again."""
 
 DEFAULT_BASE_STYLING = colorama.Style.BRIGHT + colorama.Fore.BLACK
 """Default for styling that stays the same for all tokens being displayed."""
@@ -53,6 +90,18 @@ DEFAULT_STYLING_CYCLE = (
 )
 """Default for the two or more stylings that vary across consecutive tokens."""
 
+DEFAULT_HTML_BASE_STYLING = 'color: black'
+"""Default for the CSS that stays the same for all tokens rendered as HTML."""
+
+DEFAULT_HTML_STYLING_CYCLE = (
+    'background-color: palegreen',
+    'background-color: violet',
+)
+"""Default for the CSS that varies across consecutive tokens in HTML."""
+
+Target = Literal['ansi', 'html']
+"""Kind of output to render tokens as: terminal escape sequences, or HTML."""
+
 _END_STYLED_LINE = colorama.Style.RESET_ALL + '\n'
 """String to reset styling, followed by a newline. This should not change."""
 
@@ -64,21 +113,65 @@ _RATE_PATTERN_DENOMINATOR = 1000
 
 _REQUEST_TIMEOUT = datetime.timedelta(seconds=30)
 
-_find_model_heading = functools.partial(
-    bs4.Tag.find_all,
-    name='h3',
-    attrs={'class': 'f-heading-3'},
+_HIDDEN_STYLE_PATTERN = re.compile(r'display\s*:\s*none')
+"""Regex to find elements on the pricing page that are styled not to show."""
+
+_BUNDLED_PRICES_PATH = Path(__file__).with_name('embedding_prices.json')
+"""Prices as of this package's release, for when none can be retrieved."""
+
+_RENDER_CHUNK_SIZE = 4096
+"""How many texts are rendered into each chunk of output, at most."""
+
+_new_utf8_decoder = functools.partial(
+    codecs.getincrementaldecoder('utf-8'),
+    errors='replace',
 )
-"""Select model category headings in a given element. Use like find_all."""
+"""Make a decoder that holds back the bytes of an incomplete character."""
+
+_COUNT_TASK_NAME = 'token-counts'
+"""Name of the per-text token count cache. This is not an API task."""
+
+_COUNTING_THREADS = os.cpu_count() or 1
+"""How many threads count tokens in a chunk of texts, at most."""
+
 
-_encoding = tiktoken.get_encoding('cl100k_base')
-"""cl100k_base encoder/decoder."""
+def _find_model_heading(element: 'bs4.Tag', **kwargs: Any) -> Any:
+    """Select model category headings in a given element. Use like find_all."""
+    return element.find_all(name='h3', attrs={'class': 'f-heading-3'},
+                            **kwargs)
 
-_encode_many = functools.partial(_encoding.encode_batch, num_threads=1)
-"""Separately encode all texts in a list as lists of cl100k_base tokens."""
 
-_decode_one = functools.partial(_encoding.decode, errors='strict')
-"""Decode one list of cl100k_base tokens as text. Use strict error handling."""
+@functools.cache
+def _get_encoding() -> 'tiktoken.Encoding':
+    """Get the cl100k_base encoder/decoder, loading it on first use."""
+    # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+    import tiktoken
+    return tiktoken.get_encoding('cl100k_base')
+
+
+def _count_many(texts: list[str]) -> list[int]:
+    """
+    Count cl100k_base tokens in each text, splitting the work across threads.
+
+    This encodes each slice of texts in a plain loop, since encode_batch makes
+    a future for every text, which costs more than encoding a short name. The
+    tokenizer releases the GIL while encoding, so the threads run in parallel.
+    """
+    encoding = _get_encoding()
+    slice_size = max(-(-len(texts) // _COUNTING_THREADS), 1)
+    slices = [texts[start:start + slice_size]
+              for start in range(0, len(texts), slice_size)]
+
+    def count_slice(texts_slice: list[str]) -> list[int]:
+        return [len(encoding.encode(text)) for text in texts_slice]
+
+    if len(slices) <= 1:
+        return count_slice(texts)
+
+    with concurrent.futures.ThreadPoolExecutor(len(slices)) as executor:
+        return list(itertools.chain.from_iterable(
+            executor.map(count_slice, slices),
+        ))
 
 
 class PriceRetrievalError(Exception):
@@ -113,9 +206,10 @@ def _parse_rate(text: str) -> Rate:
     return Rate(Decimal(match[1]), _RATE_PATTERN_DENOMINATOR)
 
 
-@functools.cache
 def _get_pricing_page() -> str:
     """Retrieve the pricing page from the OpenAI website."""
+    # pylint: disable-next=import-outside-toplevel
+    import requests
     response = requests.get(
         url='https://openai.com/pricing/',
         timeout=_REQUEST_TIMEOUT.total_seconds(),
@@ -131,27 +225,142 @@ def _need(condition: bool) -> None:
         raise PriceRetrievalError("can't find embedding model prices on page")
 
 
-def find_embedding_model_prices(
-    *, displayed_only: bool = True,
-) -> dict[str, Rate]:
-    """Retrieve the prices of embedding models."""
-    doc = bs4.BeautifulSoup(_get_pricing_page(), features='lxml')
+def _cell_text(cell: 'bs4.Tag') -> str:
+    """Get the text of a table cell, with its whitespace collapsed."""
+    return ' '.join(cell.get_text(' ').split())
+
+
+def _parse_prices(page: str, *, displayed_only: bool) -> dict[str, Rate]:
+    """Parse embedding model prices from the text of the pricing page."""
+    # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+    import bs4
+    doc = bs4.BeautifulSoup(page, features='lxml')
 
     headings = _find_model_heading(doc, string='Embedding models')
     _need(len(headings) == 1)
     doc_row = headings[0].parent.parent.parent.parent
     _need(len(_find_model_heading(doc_row)) == 1)
 
-    doc_row_html = io.StringIO(str(doc_row))
-    frames = pandas.read_html(doc_row_html, displayed_only=displayed_only)
-    data_header, *data_rows = (row for df in frames for row in df.values)
-    _need((data_header == ('Model', 'Usage')).all())
+    if displayed_only:
+        for element in doc_row.find_all(style=_HIDDEN_STYLE_PATTERN):
+            element.decompose()
+
+    data_header, *data_rows = (
+        [_cell_text(cell) for cell in row.find_all(['td', 'th'])]
+        for table in doc_row.find_all('table')
+        for row in table.find_all('tr')
+    )
+    _need(data_header == ['Model', 'Usage'])
+    _need(all(len(row) == 2 for row in data_rows))
     return {name: _parse_rate(text) for name, text in data_rows}
 
 
-def count(texts: list[str]) -> int:
+def _prices_path(displayed_only: bool) -> Path:
+    """Get the path of the file caching the prices last retrieved."""
+    variant = 'displayed' if displayed_only else 'all'
+    return paths.data_dir / f'embedding-prices-{variant}.json'
+
+
+def _load_prices(path: Path) -> tuple[Optional[datetime.datetime],
+                                      dict[str, Rate]]:
+    """Load prices, and when they were retrieved if that's known, from JSON."""
+    with open(path, encoding='utf-8') as file:
+        data = json.load(file)
+
+    fetched = data.get('fetched')
+    when = (None if fetched is None
+            else datetime.datetime.fromisoformat(fetched))
+    prices = {name: Rate(Decimal(numerator), denominator)
+              for name, (numerator, denominator) in data['prices'].items()}
+    return when, prices
+
+
+def _save_prices(path: Path, when: datetime.datetime,
+                 prices: dict[str, Rate]) -> None:
+    """Save prices, and when they were retrieved, as JSON."""
+    data = {
+        'fetched': when.isoformat(),
+        'prices': {name: [str(rate.numerator), rate.denominator]
+                   for name, rate in prices.items()},
+    }
+    json_bytes = json.dumps(data, indent=4).encode() + b'\n'
+    _task.replace_atomically(path, lambda file: file.write(json_bytes))
+
+
+def find_embedding_model_prices(
+    *, displayed_only: bool = True,
+    max_age: datetime.timedelta = PRICES_MAX_AGE,
+) -> dict[str, Rate]:
+    """
+    Retrieve the prices of embedding models.
+
+    Prices retrieved less than max_age ago are read from a file in the data
+    directory. Otherwise they are retrieved from the pricing page and saved.
+    If that fails, the prices last saved are used, or if there are none, the
+    snapshot bundled with this package, and a warning is logged.
+    """
+    path = _prices_path(displayed_only)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    try:
+        when, prices = _load_prices(path)
+    except FileNotFoundError:
+        when, prices = None, {}
+    if when is not None and now - when < max_age:
+        return prices
+
+    # pylint: disable-next=import-outside-toplevel
+    import requests
+    try:
+        page = _get_pricing_page()
+        fresh_prices = _parse_prices(page, displayed_only=displayed_only)
+    except (requests.RequestException, PriceRetrievalError) as error:
+        if not prices:
+            _, prices = _load_prices(_BUNDLED_PRICES_PATH)
+        logging.warning("Can't retrieve embedding model prices (%s). "
+                        'Using prices from %s.', error, when or 'a snapshot')
+        return prices
+
+    _save_prices(path, now, fresh_prices)
+    return fresh_prices
+
+
+def count(texts: Iterable[str]) -> int:
     """Count how many total cl100k_base tokens are in all the given texts."""
-    return sum(len(tokens) for tokens in _encode_many(texts))
+    return sum(iter_counts(texts))
+
+
+def count_each(texts: Iterable[str]) -> list[int]:
+    """Count how many cl100k_base tokens are in each of the given texts."""
+    return list(iter_counts(texts))
+
+
+def iter_counts(texts: Iterable[str], *,
+                chunk_size: int = COUNT_CHUNK_SIZE) -> Iterator[int]:
+    """
+    Yield how many cl100k_base tokens are in each text, in order.
+
+    Texts are consumed in chunks, so only one chunk's token lists are held at
+    a time. Counts are looked up in, and saved to, the token count cache.
+    """
+    store = _task.RecordStore(_COUNT_TASK_NAME)
+    for chunk in more_itertools.chunked(texts, chunk_size):
+        yield from _count_chunk(store, chunk)
+
+
+def _count_chunk(store: _task.RecordStore, texts: list[str]) -> list[int]:
+    """Count tokens in each text, encoding and caching only the new ones."""
+    keys = [_task.build_key(text) for text in texts]
+    misses = {key: text for key, text in zip(keys, texts) if key not in store}
+    if misses:
+        new_texts = list(misses.values())
+        store.add(list(misses), new_texts, _count_many(new_texts))
+    counts = store.gather(keys, compact=False)
+    _task.touch(_COUNT_TASK_NAME, keys)
+    return counts
+
+
+_task.register(_COUNT_TASK_NAME, _task.RecordStore)
 
 
 def report_cost(texts: list[str]) -> None:
@@ -170,38 +379,134 @@ def report_cost(texts: list[str]) -> None:
         print(line)
 
 
-def show(texts: list[str], *,
+def show(texts: Iterable[str], *,
+         target: Target = 'ansi',
          base_styling: Optional[str] = None,
-         styling_cycle: Optional[Sequence[str]] = None) -> None:
-    """Display texts, showing how they break down into cl100k_base tokens."""
+         styling_cycle: Optional[Sequence[str]] = None,
+         file: Optional[TextIO] = None) -> None:
+    """
+    Display texts, showing how they break down into cl100k_base tokens.
+
+    Output is written to file (standard output by default) in large chunks, as
+    produced by render. See render for the targets and their styling.
+    """
+    if file is None:
+        file = sys.stdout
+
+    for chunk in render(texts, target=target, base_styling=base_styling,
+                        styling_cycle=styling_cycle):
+        file.write(chunk)
+
+
+def render(texts: Iterable[str], *,
+           target: Target = 'ansi',
+           base_styling: Optional[str] = None,
+           styling_cycle: Optional[Sequence[str]] = None) -> Iterator[str]:
+    """
+    Render texts, styling their cl100k_base tokens, yielding large chunks.
+
+    For the 'ansi' target, stylings are terminal escape sequences. For 'html',
+    they are CSS declarations, and the output is one ``pre`` element. Either
+    way, each text is a line. Tokens that each hold only part of a character
+    are styled together, as one piece.
+    """
+    if target == 'ansi':
+        default_base, default_cycle = (DEFAULT_BASE_STYLING,
+                                       DEFAULT_STYLING_CYCLE)
+    elif target == 'html':
+        default_base, default_cycle = (DEFAULT_HTML_BASE_STYLING,
+                                       DEFAULT_HTML_STYLING_CYCLE)
+    else:
+        raise ValueError(f'unrecognized target: {target!r}')
+
     if base_styling is None:
-        base_styling = DEFAULT_BASE_STYLING
+        base_styling = default_base
     if styling_cycle is None:
-        styling_cycle = DEFAULT_STYLING_CYCLE
+        styling_cycle = default_cycle
 
     if len(styling_cycle) < 2:
         raise ValueError('styling cycle needs at least 2 elements')
     if len(set(styling_cycle)) != len(styling_cycle):
         raise ValueError('styling cycle elements must all be distinct')
 
-    return _do_show(texts, base_styling, styling_cycle)
+    return _do_render(texts, target, base_styling, styling_cycle)
 
 
-def _style_one(tokens: Iterable[int],
-               base_styling: str,
-               styling_cycle: Sequence[str]) -> Iterator[str]:
-    """Style a single series of tokens, yielding each styled piece."""
-    pieces = (_decode_one([token]) for token in tokens)
+class _TokenPieces(dict[int, Optional[str]]):
+    """Decoded text of each token seen, or None if it isn't complete UTF-8."""
+
+    __slots__ = ('_encoding',)
+
+    def __init__(self, encoding: 'tiktoken.Encoding') -> None:
+        """Create an empty table that decodes tokens with an encoding."""
+        super().__init__()
+        self._encoding = encoding
+
+    def __missing__(self, token: int) -> Optional[str]:
+        """Decode a token not seen before, and remember its text."""
+        try:
+            piece: Optional[str] = self.token_bytes(token).decode('utf-8')
+        except UnicodeDecodeError:
+            piece = None
+        self[token] = piece
+        return piece
 
-    for index, piece in enumerate(pieces):
-        indexed_styling = styling_cycle[index % len(styling_cycle)]
-        yield f'{base_styling}{indexed_styling}{piece}'
+    def token_bytes(self, token: int) -> bytes:
+        """Get the bytes of a token."""
+        return self._encoding.decode_single_token_bytes(token)
 
+    def split(self, tokens: list[int]) -> list[str]:
+        """Decode tokens as pieces, joining tokens that split a character."""
+        pieces: list[str] = []
+        decoder = _new_utf8_decoder()
+        partial = False
 
-def _do_show(texts: list[str],
-             base_styling: str,
-             styling_cycle: Sequence[str]) -> None:
-    """Like show. Doesn't validate arguments. Implementation detail of show."""
-    for tokens in _encode_many(texts):
-        styled_pieces = _style_one(tokens, base_styling, styling_cycle)
-        print(*styled_pieces, sep='', end=_END_STYLED_LINE)
+        for token in tokens:
+            piece = self[token]
+            if piece is None or partial:
+                piece = decoder.decode(self.token_bytes(token))
+                partial = bool(decoder.getstate()[0])
+                if not piece:
+                    continue
+            pieces.append(piece)
+
+        if partial:
+            pieces.append(decoder.decode(b'', final=True))
+
+        return pieces
+
+    def split_text(self, text: str) -> list[str]:
+        """Encode a text, and split its tokens into pieces as split does."""
+        return self.split(self._encoding.encode(text))
+
+
+def _do_render(texts: Iterable[str],
+               target: Target,
+               base_styling: str,
+               styling_cycle: Sequence[str]) -> Iterator[str]:
+    """Like render. Doesn't validate arguments. Implementation detail."""
+    if target == 'html':
+        base_styling = html.escape(base_styling)
+        starts = [f'<span style="{base_styling}; {html.escape(styling)}">'
+                  for styling in styling_cycle]
+        end, line_end = '</span>', '\n'
+        escape: Callable[[str], str] = html.escape
+        yield '<pre>'
+    else:
+        starts = [base_styling + styling for styling in styling_cycle]
+        end, line_end = '', _END_STYLED_LINE
+        escape = str
+
+    token_pieces = _TokenPieces(_get_encoding())
+
+    for chunk in more_itertools.chunked(texts, _RENDER_CHUNK_SIZE):
+        parts: list[str] = []
+        for text in chunk:
+            pieces = token_pieces.split_text(text)
+            for start, piece in zip(itertools.cycle(starts), pieces):
+                parts += (start, escape(piece), end)
+            parts.append(line_end)
+        yield ''.join(parts)
+
+    if target == 'html':
+        yield '</pre>'